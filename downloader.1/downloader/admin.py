@@ -1,3 +1,12 @@
 from django.contrib import admin
 
-# Register your models here.
+from .models import Download
+
+
+@admin.register(Download)
+class DownloadAdmin(admin.ModelAdmin):
+    list_display = ('created', 'domain', 'media_type', 'state', 'cached', 'bytes', 'fragments', 'throughput', 'title', 'task_id')
+    list_filter = ('state', 'media_type', 'cached', 'domain')
+    search_fields = ('task_id', 'url', 'title')
+    date_hierarchy = 'created'
+    readonly_fields = [field.name for field in Download._meta.fields]
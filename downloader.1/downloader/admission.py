@@ -0,0 +1,112 @@
+import math
+import time
+
+from django.conf import settings
+
+from .redis_client import get_redis
+from .routing import priority_depths
+
+DONE_PREFIX = 'downloader:admission:done:'  # per-queue sorted set of recent task runs, scored by end time
+# Per queue and priority step, task id -> time it is due. Workers hold countdown messages
+# in memory until they are due, so the broker's ready lists don't show them.
+DEFERRED_PREFIX = 'downloader:admission:deferred:'
+
+
+class Overloaded(Exception):
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def deferred_key(queue, priority):
+    return f'{DEFERRED_PREFIX}{queue}:{priority}'
+
+
+def deferred(queue, priority, task_id, countdown):
+    """Note a run sent back to a queue to start in countdown seconds"""
+    if priority is None:
+        priority = settings.CELERY_TASK_DEFAULT_PRIORITY
+    get_redis().zadd(deferred_key(queue, priority), {task_id: time.time() + countdown})
+
+
+def started(queue, task_id):
+    """A deferred run was picked up; it is no longer waiting"""
+    pipe = get_redis().pipeline(transaction=False)
+    for priority in settings.CELERY_BROKER_TRANSPORT_OPTIONS['priority_steps']:
+        pipe.zrem(deferred_key(queue, priority), task_id)
+    pipe.execute()
+
+
+def deferred_depths(queue):
+    """Deferred runs waiting on a queue per priority step"""
+    steps = settings.CELERY_BROKER_TRANSPORT_OPTIONS['priority_steps']
+    # Runs lost with their worker are redelivered within the visibility timeout or never
+    stale = time.time() - settings.CELERY_BROKER_TRANSPORT_OPTIONS['visibility_timeout']
+    pipe = get_redis().pipeline(transaction=False)
+    for priority in steps:
+        pipe.zremrangebyscore(deferred_key(queue, priority), '-inf', stale)
+        pipe.zcard(deferred_key(queue, priority))
+    counts = pipe.execute()[1::2]
+    return dict(zip(steps, counts))
+
+
+def record_completion(queue, task_id):
+    """Note that a download run on a queue ended, freeing its worker slot"""
+    config = settings.VIDEO_DOWNLOADER['ADMISSION']
+    now = time.time()
+    pipe = get_redis().pipeline(transaction=False)
+    # Deferred and retried tasks end several runs under one id, so each run gets its own member
+    pipe.zadd(DONE_PREFIX + queue, {f'{task_id}:{now}': now})
+    pipe.zremrangebyscore(DONE_PREFIX + queue, 0, now - config['RATE_WINDOW'])
+    pipe.expire(DONE_PREFIX + queue, config['RATE_WINDOW'])
+    pipe.execute()
+
+
+def completion_rates(queues):
+    """Runs finished per second per queue over RATE_WINDOW (None while there are too few to tell)"""
+    config = settings.VIDEO_DOWNLOADER['ADMISSION']
+    now = time.time()
+    pipe = get_redis().pipeline(transaction=False)
+    for queue in queues:
+        pipe.zcount(DONE_PREFIX + queue, now - config['RATE_WINDOW'], '+inf')
+        pipe.zrangebyscore(DONE_PREFIX + queue, now - config['RATE_WINDOW'], '+inf', start=0, num=1, withscores=True)
+    results = iter(pipe.execute())
+
+    rates = {}
+    for queue in queues:
+        count, oldest = next(results), next(results)
+        if count < config['MIN_COMPLETIONS']:
+            rates[queue] = None
+        else:
+            # A queue that only got busy recently is measured over the time it has been busy
+            rates[queue] = count / max(now - oldest[0][1], 1)
+    return rates
+
+
+def admit(queue, priority):
+    """Seconds until a new download on a queue is expected to start (None if unknown).
+
+    Only messages the broker serves before this one count: those at the same or a
+    more urgent priority, waiting in the queue or deferred to a booked start. Messages
+    a worker has prefetched (at most one per process) are not counted. Raises
+    Overloaded when that backlog would take longer than MAX_QUEUE_WAIT to drain at
+    the recent completion rate, or exceeds MAX_QUEUE_DEPTH.
+    """
+    config = settings.VIDEO_DOWNLOADER['ADMISSION']
+    ready = priority_depths([queue])[queue]
+    waiting = deferred_depths(queue)
+    ahead = sum(ready[step] + waiting[step] for step in ready if step <= priority)
+    rate = completion_rates([queue])[queue]
+
+    if ahead >= config['MAX_QUEUE_DEPTH']:
+        excess = ahead - config['MAX_QUEUE_DEPTH'] + 1
+        retry_after = excess / rate if rate else config['RETRY_AFTER']
+        raise Overloaded('The download queue is full. Please try again later.', math.ceil(retry_after))
+    if rate is None:
+        return None
+
+    wait = ahead / rate
+    if wait > config['MAX_QUEUE_WAIT']:
+        # By then enough of the backlog has drained for a new download to be admitted
+        raise Overloaded('The server is busy. Please try again later.', math.ceil(wait - config['MAX_QUEUE_WAIT']))
+    return wait
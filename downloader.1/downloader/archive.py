@@ -0,0 +1,96 @@
+"""ZIP archives of finished downloads, streamed as they are written.
+
+Files are stored, not recompressed (media doesn't shrink), and zipfile writes to a
+sink that is emptied after every chunk, so memory stays at about one chunk however
+large the set. Entries and the central directory switch to ZIP64 when sizes or
+offsets need it.
+"""
+import os
+import time
+import zipfile
+from contextlib import closing
+
+from . import quota, status
+from .models import Download
+from .storage import get_storage
+
+class Sink:
+    """Unseekable file object holding what zipfile wrote until it is sent"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data, self.chunks = b''.join(self.chunks), []
+        return data
+
+def entries(task_ids):
+    """(archive name, file path, size) for each of the tasks whose download succeeded"""
+    task_ids = list(dict.fromkeys(task_ids))
+    results = status.read_results(task_ids)
+    # Results the backend has forgotten are still in the download history
+    rows = {
+        row.task_id: row for row in Download.objects.filter(
+            task_id__in=[task_id for task_id in task_ids if task_id not in results], state=Download.SUCCESS)
+    }
+
+    found = []
+    names = set()
+    for task_id in task_ids:
+        if task_id in results:
+            result = results[task_id]
+            if result.get('status') != 'success':
+                continue
+            file_path, filename, size = result['file_path'], result.get('filename'), result.get('size')
+        elif task_id in rows:
+            row = rows[task_id]
+            file_path, filename, size = row.file_path, row.filename, row.bytes or None
+        else:
+            continue
+        found.append((unique_name(filename or os.path.basename(file_path), names), file_path, size))
+        quota.touch(file_path)
+    return found
+
+def unique_name(filename, taken):
+    """A flat archive name, numbered like 'title (2).mp4' if another entry has it"""
+    filename = filename.replace('/', '_').replace('\\', '_')
+    stem, ext = os.path.splitext(filename)
+    name, number = filename, 1
+    while name.lower() in taken:
+        number += 1
+        name = f'{stem} ({number}){ext}'
+    taken.add(name.lower())
+    return name
+
+def iter_zip(files, chunk_size):
+    """Yield a stored ZIP of (archive name, file path, size) entries.
+
+    Files that are gone by the time their turn comes (e.g. evicted) are left out.
+    """
+    storage = get_storage()
+    sink = Sink()
+    date_time = time.localtime()[:6]
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+        for name, file_path, size in files:
+            try:
+                source = storage.open(file_path)
+            except OSError as e:
+                print(f"Leaving {file_path} out of the archive: {e}")
+                continue
+            info = zipfile.ZipInfo(name, date_time=date_time)
+            info.external_attr = 0o644 << 16
+            # The size decides up front whether the entry needs ZIP64 fields
+            info.file_size = size or 0
+            with closing(source), archive.open(info, 'w', force_zip64=size is None) as entry:
+                while chunk := source.read(chunk_size):
+                    entry.write(chunk)
+                    yield sink.drain()
+            yield sink.drain()
+    yield sink.drain()
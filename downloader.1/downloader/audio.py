@@ -0,0 +1,50 @@
+import os
+
+import yt_dlp
+from django.conf import settings
+from yt_dlp.postprocessor.ffmpeg import FFmpegPostProcessor
+
+def default_format(audio_format):
+    return audio_format or settings.VIDEO_DOWNLOADER['DEFAULT_AUDIO_FORMAT']
+
+def audio_format_spec(audio_format):
+    return settings.VIDEO_DOWNLOADER['AUDIO_FORMATS'][audio_format]
+
+def variant_path(source_path, audio_format):
+    """Where an audio variant of a download is kept: next to it, named by bitrate and format"""
+    stem = os.path.splitext(source_path)[0]
+    return f"{stem}.{audio_format_spec(audio_format)['bitrate']}.{audio_format}"
+
+def ffmpeg():
+    """yt-dlp's ffmpeg wrapper, which finds the executables the same way downloads do"""
+    return FFmpegPostProcessor(yt_dlp.YoutubeDL({'quiet': True}))
+
+def extract(source_path, audio_format):
+    """Write the audio variant of a file (unless it already exists) and return its path.
+
+    AAC audio is copied into m4a without re-encoding; anything else is transcoded
+    with the codec and bitrate from AUDIO_FORMATS.
+    """
+    target = variant_path(source_path, audio_format)
+    if os.path.exists(target):
+        return target
+
+    pp = ffmpeg()
+    if not pp.available:
+        raise RuntimeError('ffmpeg is required for audio extraction')
+    spec = audio_format_spec(audio_format)
+    if spec['codec'] == 'aac' and pp.get_audio_codec(source_path) == 'aac':
+        codec = ['-acodec', 'copy']
+    else:
+        codec = ['-acodec', spec['codec'], '-b:a', spec['bitrate']]
+
+    # Written under a .part name so storage maintenance cleans up after a crash
+    partial = target + '.part'
+    try:
+        pp.run_ffmpeg(source_path, partial, ['-vn', *codec, '-f', spec['container']])
+    except Exception:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    os.replace(partial, target)
+    return target
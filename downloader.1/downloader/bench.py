@@ -0,0 +1,131 @@
+"""Synthetic media for offline benchmarks: a local HTTP server and a yt-dlp extractor for it.
+
+Page URLs look like http://127.0.0.1:<port>/bench/<progressive|hls>/<id>?size=<bytes>&segment=<bytes>;
+BenchIE turns them into a single MP4 or an HLS playlist served by MediaHandler,
+without any request leaving the machine.
+"""
+import math
+import os
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+from yt_dlp.extractor.common import InfoExtractor
+
+DEFAULT_SIZE = 8 * 1024 * 1024
+DEFAULT_SEGMENT = 512 * 1024
+WRITE_SIZE = 64 * 1024
+
+# Every response is cut from this block, so serving costs no more than copying bytes
+PAYLOAD = os.urandom(1024 * 1024)
+
+MEDIA_RE = re.compile(r'^/media/[\w-]+\.mp4$')
+PLAYLIST_RE = re.compile(r'^/hls/(?P<id>[\w-]+)/index\.m3u8$')
+SEGMENT_RE = re.compile(r'^/hls/[\w-]+/seg\d+\.ts$')
+RANGE_RE = re.compile(r'^bytes=(\d+)-(\d*)$')
+
+
+class MediaHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        parts = urlparse(self.path)
+        query = dict(parse_qsl(parts.query))
+        size = int(query.get('size', DEFAULT_SIZE))
+        segment = int(query.get('segment', DEFAULT_SEGMENT))
+
+        if MEDIA_RE.match(parts.path):
+            self.send_payload(size, 'video/mp4')
+        elif SEGMENT_RE.match(parts.path):
+            self.send_payload(size, 'video/mp2t')
+        elif PLAYLIST_RE.match(parts.path):
+            self.send_playlist(size, segment)
+        else:
+            self.send_error(404)
+
+    def send_playlist(self, size, segment):
+        count = max(math.ceil(size / segment), 1)
+        lines = ['#EXTM3U', '#EXT-X-VERSION:3', '#EXT-X-TARGETDURATION:2', '#EXT-X-MEDIA-SEQUENCE:0']
+        for index in range(count):
+            length = min(segment, size - index * segment)
+            lines += ['#EXTINF:2.0,', f'seg{index}.ts?size={length}']
+        lines.append('#EXT-X-ENDLIST')
+        body = ('\n'.join(lines) + '\n').encode('ascii')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/vnd.apple.mpegurl')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_payload(self, size, content_type):
+        start, end = 0, size - 1
+        match = RANGE_RE.match(self.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            if match.group(2):
+                end = min(int(match.group(2)), size - 1)
+            if start >= size:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+        view = memoryview(PAYLOAD)
+        position = start
+        while position <= end:
+            offset = position % len(PAYLOAD)
+            length = min(WRITE_SIZE, end - position + 1, len(PAYLOAD) - offset)
+            self.wfile.write(view[offset:offset + length])
+            position += length
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server():
+    """Serve synthetic media on a free loopback port; returns (server, base_url)"""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), MediaHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address
+    return server, f'http://{host}:{port}'
+
+
+def page_url(base_url, kind, video_id, size, segment=DEFAULT_SEGMENT):
+    return f'{base_url}/bench/{kind}/{video_id}?size={size}&segment={segment}'
+
+
+class BenchIE(InfoExtractor):
+    """Stub extractor for the synthetic media server; enable it through EXTRA_EXTRACTORS"""
+    IE_NAME = 'bench'
+    _VALID_URL = r'https?://127\.0\.0\.1:\d+/bench/(?P<kind>progressive|hls)/(?P<id>[\w-]+)'
+    _RETURN_TYPE = 'video'
+
+    def _real_extract(self, url):
+        kind, video_id = self._match_valid_url(url).group('kind', 'id')
+        parts = urlparse(url)
+        base = f'{parts.scheme}://{parts.netloc}'
+        if kind == 'hls':
+            fmt = {
+                'format_id': 'hls',
+                'url': f'{base}/hls/{video_id}/index.m3u8?{parts.query}',
+                'protocol': 'm3u8_native',
+                'ext': 'mp4',
+            }
+        else:
+            fmt = {
+                'format_id': 'progressive',
+                'url': f'{base}/media/{video_id}.mp4?{parts.query}',
+                'ext': 'mp4',
+            }
+        return {'id': video_id, 'title': f'Benchmark {kind} {video_id}', 'formats': [fmt]}
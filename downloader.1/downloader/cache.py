@@ -0,0 +1,101 @@
+import json
+import time
+
+from django.conf import settings
+
+from . import metrics, quota
+from .models import Download
+from .redis_client import get_redis
+from .storage import get_storage
+
+# Cached results live in one hash so the byte counter never drifts from a TTL expiry
+ENTRIES_KEY = 'downloader:cache:entries'
+LRU_KEY = 'downloader:cache:lru'          # key -> last access time
+CREATED_KEY = 'downloader:cache:created'  # key -> time the file was cached
+BYTES_KEY = 'downloader:cache:bytes'
+
+def lookup(key):
+    """Return the cached result for a media key, or None on a miss"""
+    entry = find(key)
+    metrics.inc('downloader_cache_lookups_total', result='hit' if entry else 'miss')
+    return entry
+
+def find(key):
+    r = get_redis()
+    raw = r.hget(ENTRIES_KEY, key)
+    if raw is None:
+        return recorded(key)
+    entry = json.loads(raw)
+    max_age = settings.VIDEO_DOWNLOADER['CACHE_MAX_AGE']
+    if time.time() - entry['cached_at'] > max_age or not get_storage().exists(entry['file_path']):
+        drop(key)
+        return None
+    r.zadd(LRU_KEY, {key: time.time()})
+    return entry
+
+def recorded(key):
+    """Fall back to download history, e.g. after Redis lost the cache index"""
+    row = Download.objects.recent_success(key, settings.VIDEO_DOWNLOADER['CACHE_MAX_AGE'])
+    if row is None or not get_storage().exists(row.file_path):
+        return None
+    result = {
+        'status': 'success',
+        'file_path': row.file_path,
+        'filename': row.filename,
+        'title': row.title,
+        'size': row.bytes,
+    }
+    store(key, result)
+    return result
+
+def store(key, result):
+    """Remember a finished download and evict old entries if over budget"""
+    file_path = result.get('file_path')
+    if result.get('status') != 'success' or not file_path or not get_storage().exists(file_path):
+        return
+    size = result['size']
+    if size > settings.VIDEO_DOWNLOADER['CACHE_MAX_BYTES']:
+        return
+
+    r = get_redis()
+    now = time.time()
+    entry = dict(result, size=size, cached_at=now)
+    previous = r.hget(ENTRIES_KEY, key)
+    pipe = r.pipeline()
+    pipe.hset(ENTRIES_KEY, key, json.dumps(entry))
+    pipe.zadd(LRU_KEY, {key: now})
+    pipe.zadd(CREATED_KEY, {key: now})
+    pipe.incrby(BYTES_KEY, size - (json.loads(previous)['size'] if previous else 0))
+    pipe.execute()
+    evict()
+
+def drop(key, remove_file=False):
+    """Forget a cache entry, optionally deleting its file"""
+    r = get_redis()
+    raw = r.hget(ENTRIES_KEY, key)
+    pipe = r.pipeline()
+    pipe.hdel(ENTRIES_KEY, key)
+    pipe.zrem(LRU_KEY, key)
+    pipe.zrem(CREATED_KEY, key)
+    removed = pipe.execute()[0]
+    if not raw or not removed:
+        return
+    entry = json.loads(raw)
+    r.decrby(BYTES_KEY, entry['size'])
+    if remove_file:
+        quota.remove(entry['file_path'])
+
+def evict():
+    """Drop entries older than CACHE_MAX_AGE, then least recently used ones over CACHE_MAX_BYTES"""
+    r = get_redis()
+    config = settings.VIDEO_DOWNLOADER
+
+    expired = r.zrangebyscore(CREATED_KEY, '-inf', time.time() - config['CACHE_MAX_AGE'])
+    for key in expired:
+        drop(key, remove_file=True)
+
+    while int(r.get(BYTES_KEY) or 0) > config['CACHE_MAX_BYTES']:
+        oldest = r.zpopmin(LRU_KEY)
+        if not oldest:
+            break
+        drop(oldest[0][0], remove_file=True)
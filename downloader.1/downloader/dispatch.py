@@ -0,0 +1,90 @@
+from celery import states
+from celery.utils import uuid
+
+from . import admission, cache, history, limiter, metrics, singleflight
+from .keys import media_key, request_key
+from .routing import route_for
+from .tasks import download_video_task, extract_audio_task, extract_domain
+
+
+class RateLimited(Exception):
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def take_limits(domain, task_id):
+    """Take one of the domain's tokens and a concurrency lease, or raise RateLimited"""
+    allowed, reason, retry_after = limiter.admit(domain, task_id)
+    if not allowed:
+        metrics.inc('downloader_rate_limited_total', reason=reason, domain=domain)
+        if reason == 'concurrency':
+            message = f'Too many active downloads from {domain}. Please wait for current downloads to complete.'
+        else:
+            message = f'Rate limit exceeded for {domain}. Please wait a few minutes before trying again.'
+        raise RateLimited(message, retry_after)
+
+
+def counted(task_id, how, signature, row, wait=None):
+    metrics.inc('downloader_submissions_total', how=how)
+    return task_id, how, signature, row, wait
+
+
+def prepare(url, media_type, admit=True, audio_format=None):
+    """Resolve a download request to a task id without sending anything yet.
+
+    Returns (task_id, how, signature, row, wait): how is 'cached', 'coalesced' or 'queued',
+    signature is the task the caller must send for 'queued' requests, row is the
+    unsaved Download the caller must save (both None when they don't apply) and wait
+    the estimated seconds before an admitted download starts (None if unknown).
+    Raises Overloaded when admit is set and the download queue is over capacity, and
+    RateLimited when the domain's limits are exhausted. Without admit, the task takes
+    the domain's token and lease itself when it starts.
+    """
+    key = request_key(url, media_type, audio_format)
+    domain = extract_domain(url)
+
+    # Serve repeat requests from the cache without touching a worker
+    cached = cache.lookup(key)
+    if cached:
+        task_id = uuid()
+        download_video_task.backend.store_result(task_id, dict(cached, cached=True), states.SUCCESS)
+        return counted(task_id, 'cached', None, history.submitted(url, media_type, task_id, key, domain, 'cached', cached))
+
+    # Attach to an identical download that is already queued or running
+    task_id = uuid()
+    owner = singleflight.claim(key, task_id)
+    if owner != task_id:
+        return counted(owner, 'coalesced', None, None)
+
+    # Audio of a video we already have is extracted locally, without touching the site
+    if media_type == 'audio':
+        source = cache.lookup(media_key(url, 'video'))
+        if source:
+            signature = extract_audio_task.s(url, audio_format, source).set(task_id=task_id)
+            return counted(task_id, 'queued', signature, history.submitted(url, media_type, task_id, key, domain, 'queued'))
+
+    # Refuse work the queue can't start soon, before it takes any of the domain's tokens
+    wait = None
+    if admit:
+        queue, priority = route_for(url, media_type)
+        try:
+            wait = admission.admit(queue, priority)
+        except admission.Overloaded:
+            singleflight.release(key, task_id)
+            metrics.inc('downloader_overloaded_total', queue=queue)
+            raise
+
+    # Check rate limiting: one token per download and at most N running per domain
+    if admit:
+        try:
+            take_limits(domain, task_id)
+        except RateLimited:
+            singleflight.release(key, task_id)
+            raise
+
+    options = {'audio_format': audio_format} if media_type == 'audio' else {}
+    if not admit:
+        options['batch'] = True
+    signature = download_video_task.s(url, media_type, **options).set(task_id=task_id)
+    return counted(task_id, 'queued', signature, history.submitted(url, media_type, task_id, key, domain, 'queued'), wait)
@@ -0,0 +1,82 @@
+import threading
+import time
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import Download
+
+# Pending field updates per task id, written in bulk by flush()
+_pending = {}
+_oldest = None
+# Progress hooks may run on other threads than the task (e.g. fragment downloads)
+_lock = threading.Lock()
+
+
+def submitted(url, media_type, task_id, key, domain, how, cached_result=None):
+    """Unsaved Download row for a new submission (callers save or bulk_create it)"""
+    row = Download(task_id=task_id, url=url, key=key, domain=domain, media_type=media_type)
+    if how == 'cached':
+        now = timezone.now()
+        row.state = Download.SUCCESS
+        row.cached = True
+        row.started = row.finished = now
+        row.file_path = cached_result['file_path']
+        row.filename = cached_result.get('filename') or ''
+        row.title = cached_result.get('title') or ''
+        row.bytes = cached_result.get('size') or 0
+    return row
+
+
+def update(task_id, **fields):
+    """Queue field changes for a task's row; flushed together with other tasks' changes"""
+    global _oldest
+    config = settings.VIDEO_DOWNLOADER
+    with _lock:
+        _pending.setdefault(task_id, {}).update(fields)
+        if _oldest is None:
+            _oldest = time.monotonic()
+        due = len(_pending) >= config['HISTORY_FLUSH_SIZE'] or time.monotonic() - _oldest >= config['HISTORY_FLUSH_INTERVAL']
+    if due:
+        flush()
+
+
+def finished(task_id, result):
+    """Record a task's outcome from its return value"""
+    fields = {'finished': timezone.now()}
+    if isinstance(result, dict) and result.get('status') == 'success':
+        fields.update(
+            state=Download.SUCCESS,
+            cached=bool(result.get('cached')),
+            file_path=result['file_path'],
+            filename=result.get('filename') or '',
+            title=result.get('title') or '',
+            bytes=result.get('size', 0),
+        )
+    else:
+        error = result.get('error') if isinstance(result, dict) else str(result)
+        fields.update(state=Download.FAILED, error=error or '')
+    update(task_id, **fields)
+
+
+def flush(task_ids=None):
+    """Write queued updates (all, or only those of task_ids) with one SELECT and one bulk UPDATE"""
+    global _pending, _oldest
+    with _lock:
+        if task_ids is None:
+            pending, _pending = _pending, {}
+        else:
+            pending = {task_id: _pending.pop(task_id) for task_id in task_ids if task_id in _pending}
+        if not _pending:
+            _oldest = None
+    if not pending:
+        return
+
+    rows = list(Download.objects.filter(task_id__in=pending.keys()))
+    changed_fields = set()
+    for row in rows:
+        for name, value in pending[row.task_id].items():
+            setattr(row, name, value)
+            changed_fields.add(name)
+    if rows:
+        Download.objects.bulk_update(rows, sorted(changed_fields))
@@ -0,0 +1,95 @@
+import hashlib
+from functools import lru_cache
+from urllib.parse import urlparse, parse_qsl, urlencode, urlunparse
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+from yt_dlp.extractor import gen_extractor_classes
+
+# Query parameters that never change which video a URL points to
+TRACKING_PARAMS = {'si', 'feature', 'fbclid', 'gclid', 'igshid', 'pp', 'ab_channel'}
+# Downloads run with noplaylist, so a video URL's playlist context doesn't matter either
+PLAYLIST_PARAMS = {'list', 'index', 'start_radio'}
+
+_extractors = None
+
+def extra_extractors():
+    """Extractor classes listed in VIDEO_DOWNLOADER['EXTRA_EXTRACTORS']"""
+    return [import_string(path) for path in settings.VIDEO_DOWNLOADER['EXTRA_EXTRACTORS']]
+
+def get_extractors():
+    """yt-dlp extractor classes in match order, without the generic fallback"""
+    global _extractors
+    if _extractors is None:
+        _extractors = [ie for ie in gen_extractor_classes() if ie.ie_key() != 'Generic']
+    return extra_extractors() + _extractors
+
+def extra_extractor(url):
+    """The configured extra extractor that handles a URL, if any"""
+    for ie in extra_extractors():
+        if ie.suitable(url):
+            return ie
+    return None
+
+def normalize_url(url):
+    """Lowercase the host and drop fragments and tracking parameters"""
+    parts = urlparse(url.strip())
+    netloc = parts.netloc.lower()
+    if netloc.startswith('www.'):
+        netloc = netloc[4:]
+    query = sorted(
+        (k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+        if k not in TRACKING_PARAMS and not k.startswith('utm_')
+    )
+    return urlunparse((parts.scheme.lower(), netloc, parts.path, '', urlencode(query), ''))
+
+def strip_playlist(url):
+    """Drop the playlist a video URL was opened from (watch?v=...&list=...)"""
+    parts = urlparse(url)
+    query = parse_qsl(parts.query, keep_blank_values=True)
+    if not any(k == 'v' for k, _ in query):
+        return url
+    query = [(k, v) for k, v in query if k not in PLAYLIST_PARAMS]
+    return urlunparse(parts._replace(query=urlencode(query)))
+
+def first_extractor(url):
+    """The extractor yt-dlp would pick for a URL, or None for the generic one"""
+    for ie in get_extractors():
+        try:
+            if ie.suitable(url):
+                return ie
+        except Exception:
+            continue
+    return None
+
+def may_be_playlist(url):
+    """Whether a URL needs a metadata pass to find out if it lists several videos"""
+    ie = first_extractor(strip_playlist(url))
+    return ie is not None and getattr(ie, '_RETURN_TYPE', 'any') != 'video'
+
+@lru_cache(maxsize=4096)
+def match_extractor(url):
+    """Return (extractor, video id) for a URL without touching the network"""
+    url = strip_playlist(url)
+    ie = first_extractor(url)
+    video_id = ie.get_temp_id(url) if ie else None
+    if video_id:
+        return ie.ie_key(), video_id
+    return 'generic', normalize_url(url)
+
+def media_key(url, media_type, variant=None):
+    """Stable key for (extractor, video id, media_type, format)"""
+    extractor, video_id = match_extractor(url)
+    if variant is None:
+        variant = settings.VIDEO_DOWNLOADER['FORMATS'].get(media_type, '')
+    raw = f'{extractor}:{video_id}:{media_type}:{variant}'
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+def request_key(url, media_type, audio_format=None):
+    """Media key for a request; audio is keyed by output format and bitrate"""
+    if media_type != 'audio':
+        return media_key(url, media_type)
+    config = settings.VIDEO_DOWNLOADER
+    audio_format = audio_format or config['DEFAULT_AUDIO_FORMAT']
+    bitrate = config['AUDIO_FORMATS'][audio_format]['bitrate']
+    return media_key(url, media_type, f"{config['FORMATS']['audio']}:{audio_format}:{bitrate}")
@@ -0,0 +1,147 @@
+import random
+import time
+
+from django.conf import settings
+
+from .redis_client import get_redis
+
+BUCKET_PREFIX = 'downloader:limit:bucket:'   # per-domain token bucket
+ACTIVE_PREFIX = 'downloader:limit:active:'   # per-domain semaphore, task id -> lease expiry
+SLOT_PREFIX = 'downloader:limit:slot:'       # per-domain spacing between task starts
+
+# Takes a token and a concurrency lease together, or neither
+ADMIT_SCRIPT = """
+local t = redis.call('time')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local max_active = tonumber(ARGV[3])
+local lease = tonumber(ARGV[4])
+local busy_retry = tonumber(ARGV[6])
+
+local bucket = redis.call('hmget', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + (now - ts) * rate)
+
+-- Leases of downloads that never released them run out on their own
+redis.call('zremrangebyscore', KEYS[2], '-inf', now)
+-- A download that was already admitted (e.g. a retried batch item) is not charged twice
+if redis.call('zscore', KEYS[2], ARGV[5]) then
+    redis.call('zadd', KEYS[2], now + lease, ARGV[5])
+    return {1, '', '0'}
+end
+if redis.call('zcard', KEYS[2]) >= max_active then
+    -- Lease expiry only bounds a hung download; running ones usually end much sooner
+    local oldest = redis.call('zrange', KEYS[2], 0, 0, 'WITHSCORES')
+    return {0, 'concurrency', tostring(math.min(tonumber(oldest[2]) - now, busy_retry))}
+end
+if tokens < 1 then
+    return {0, 'rate', tostring((1 - tokens) / rate)}
+end
+
+redis.call('hset', KEYS[1], 'tokens', tostring(tokens - 1), 'ts', tostring(now))
+redis.call('expire', KEYS[1], math.ceil(capacity / rate) + 1)
+redis.call('zadd', KEYS[2], now + lease, ARGV[5])
+redis.call('expire', KEYS[2], math.ceil(lease) + 1)
+return {1, '', '0'}
+"""
+
+# Starts or extends a download's lease, counted from now (ARGV[3] = '1': extend only)
+HOLD_SCRIPT = """
+local t = redis.call('time')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local lease = tonumber(ARGV[1])
+if ARGV[3] == '1' then
+    redis.call('zadd', KEYS[1], 'XX', now + lease, ARGV[2])
+else
+    redis.call('zadd', KEYS[1], now + lease, ARGV[2])
+end
+redis.call('expire', KEYS[1], math.ceil(lease) + 1)
+"""
+
+# Books the next start time for a domain, unless it is more than max_ahead seconds out.
+# Returns {1, wait for the booked slot} or {0, wait until it is within reach}
+SLOT_SCRIPT = """
+local t = redis.call('time')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local gap = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local cooldown = tonumber(ARGV[3])
+local max_ahead = tonumber(ARGV[4])
+
+local state = redis.call('hmget', KEYS[1], 'next', 'count')
+local start = math.max(now, tonumber(state[1]) or 0)
+local count = (tonumber(state[2]) or 0) + 1
+if count > burst then
+    count = 0
+    start = start + cooldown
+end
+if start - now > max_ahead then
+    return {0, tostring(start - now - max_ahead)}
+end
+
+redis.call('hset', KEYS[1], 'next', tostring(start + gap), 'count', count)
+redis.call('expire', KEYS[1], math.ceil(start + gap - now + cooldown) + 1)
+return {1, tostring(start - now)}
+"""
+
+_scripts = {}
+
+def _script(source):
+    if source not in _scripts:
+        _scripts[source] = get_redis().register_script(source)
+    return _scripts[source]
+
+def admit(domain, task_id):
+    """Try to start a download for a domain; returns (allowed, reason, retry_after).
+
+    When the domain is at its concurrency limit, retry_after is at most the spacing
+    between downloads rather than the time until the oldest lease would expire.
+    """
+    config = settings.VIDEO_DOWNLOADER
+    capacity = config['MAX_DOWNLOADS_PER_DOMAIN_PER_5MIN']
+    allowed, reason, retry_after = _script(ADMIT_SCRIPT)(
+        keys=[BUCKET_PREFIX + domain, ACTIVE_PREFIX + domain],
+        args=[capacity, capacity / 300, config['MAX_CONCURRENT_DOWNLOADS_PER_DOMAIN'],
+              config['DOWNLOAD_TIMEOUT'] + config['TIME_LIMIT_GRACE'], task_id,
+              config['MIN_DELAY_BETWEEN_DOWNLOADS']],
+    )
+    return bool(allowed), reason, float(retry_after)
+
+def hold(domain, task_id, extend_only=False):
+    """Make a download's concurrency lease last for one full run from now.
+
+    The lease taken by admit() counts from submission, so queueing and deferrals
+    can use it up before the download starts; every run renews it. With
+    extend_only, a download without a lease (one not admitted yet) doesn't get one.
+    """
+    config = settings.VIDEO_DOWNLOADER
+    _script(HOLD_SCRIPT)(
+        keys=[ACTIVE_PREFIX + domain],
+        args=[config['DOWNLOAD_TIMEOUT'] + config['TIME_LIMIT_GRACE'], task_id, int(extend_only)],
+    )
+
+def holds(domain, task_id):
+    """Whether a download still holds an unexpired concurrency lease"""
+    expiry = get_redis().zscore(ACTIVE_PREFIX + domain, task_id)
+    return expiry is not None and expiry > time.time()
+
+def release(domain, task_id):
+    """Give back the concurrency lease taken by admit()"""
+    get_redis().zrem(ACTIVE_PREFIX + domain, task_id)
+
+def reserve_slot(domain, max_ahead):
+    """Book this task's start time for the domain, at most max_ahead seconds out.
+
+    Returns (booked, seconds): the wait for the booked slot, or if the domain is
+    booked further ahead than that, how long until it is worth asking again.
+    """
+    config = settings.VIDEO_DOWNLOADER
+    gap = config['MIN_DELAY_BETWEEN_DOWNLOADS'] + random.uniform(*config['MIN_DELAY_JITTER'])
+    cooldown = random.uniform(*config['BURST_COOLDOWN'])
+    booked, wait = _script(SLOT_SCRIPT)(
+        keys=[SLOT_PREFIX + domain],
+        args=[gap, config['BURST_SIZE'], cooldown, max_ahead],
+    )
+    return bool(booked), float(wait)
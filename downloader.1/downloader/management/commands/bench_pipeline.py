@@ -0,0 +1,185 @@
+import asyncio
+import contextlib
+import json
+import os
+import shutil
+import statistics
+import time
+
+from celery.contrib.testing.worker import start_worker
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import AsyncClient, Client, override_settings
+from django.utils.crypto import get_random_string
+
+from downloader import bench, cache, history, quota, status, tuning
+from downloader.models import Download
+from downloader.redis_client import get_redis
+from downloader.tasks import extract_domain
+from videodownload.celery import app
+
+KINDS = ['progressive', 'hls']
+FINAL_STATES = ('success', 'error', 'failed')
+
+
+def summarize(values):
+    if not values:
+        return None
+    values = sorted(values)
+    return {
+        'count': len(values),
+        'mean': statistics.fmean(values),
+        'median': values[len(values) // 2],
+        'p95': values[min(int(len(values) * 0.95), len(values) - 1)],
+        'max': values[-1],
+    }
+
+
+class Command(BaseCommand):
+    help = ('Run downloads end to end against a local synthetic media server (no network) '
+            'and report submit latency, queue wait, throughput and endpoint speed')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--jobs', type=int, default=8, help='Downloads to submit, alternating progressive and HLS')
+        parser.add_argument('--size-mb', type=int, default=8, help='Size of each synthetic video')
+        parser.add_argument('--segment-kb', type=int, default=512, help='HLS segment size')
+        parser.add_argument('--concurrency', type=int, default=4, help='Threads of the in-process worker')
+        parser.add_argument('--status-requests', type=int, default=500, help='Requests for the status endpoint runs')
+        parser.add_argument('--timeout', type=int, default=300, help='Seconds to wait for all downloads')
+        parser.add_argument('--with-limits', action='store_true',
+                            help='Keep the per-domain rate limits and spacing instead of lifting them')
+        parser.add_argument('--verbose', action='store_true', help="Show the worker's and yt-dlp's output")
+        parser.add_argument('--output', help='Write the results as JSON to this file')
+
+    def handle(self, *args, **options):
+        config = dict(settings.VIDEO_DOWNLOADER)
+        config['EXTRA_EXTRACTORS'] = [*config['EXTRA_EXTRACTORS'], 'downloader.bench.BenchIE']
+        if not options['with_limits']:
+            config.update(
+                MAX_DOWNLOADS_PER_DOMAIN_PER_5MIN=10 ** 6,
+                MAX_CONCURRENT_DOWNLOADS_PER_DOMAIN=10 ** 6,
+                MIN_DELAY_BETWEEN_DOWNLOADS=0,
+                MIN_DELAY_JITTER=(0, 0),
+                BURST_SIZE=10 ** 6,
+            )
+
+        server, base_url = bench.start_server()
+        task_ids = []
+        output = None if options['verbose'] else open(os.devnull, 'w')
+        quiet = contextlib.redirect_stdout(output) if output else contextlib.nullcontext()
+        try:
+            with override_settings(VIDEO_DOWNLOADER=config), quiet:
+                try:
+                    with start_worker(app, concurrency=options['concurrency'], pool='threads',
+                                      perform_ping_check=False, shutdown_timeout=options['timeout']):
+                        report = self.run(base_url, options, task_ids)
+                finally:
+                    self.clean_up(task_ids, extract_domain(base_url))
+        finally:
+            server.shutdown()
+            if output:
+                output.close()
+
+        self.stdout.write(json.dumps(report, indent=2))
+        if options['output']:
+            with open(options['output'], 'w') as out:
+                json.dump(report, out, indent=2)
+
+    def run(self, base_url, options, task_ids):
+        client = Client()
+        size = options['size_mb'] * 1024 * 1024
+        run_id = get_random_string(8).lower()
+
+        # Submit through the real view, as the frontend does
+        submit = []
+        started = time.perf_counter()
+        for index in range(options['jobs']):
+            url = bench.page_url(base_url, KINDS[index % len(KINDS)], f'{run_id}-{index}', size,
+                                 options['segment_kb'] * 1024)
+            begin = time.perf_counter()
+            response = client.post('/', {'url': url, 'media_type': 'video'}, content_type='application/json')
+            submit.append(time.perf_counter() - begin)
+            if response.status_code != 200:
+                raise CommandError(f'Submit failed with {response.status_code}: {response.content[:200]!r}')
+            task_ids.append(response.json()['task_id'])
+
+        deadline = time.monotonic() + options['timeout']
+        while True:
+            states = status.read_states(task_ids)
+            if all(state['state'] in FINAL_STATES for state in states.values()):
+                break
+            if time.monotonic() > deadline:
+                raise CommandError(f'Downloads did not finish within {options["timeout"]} seconds')
+            time.sleep(0.05)
+        wall = time.perf_counter() - started
+
+        history.flush()
+        rows = list(Download.objects.filter(task_id__in=task_ids))
+        succeeded = [row for row in rows if row.state == Download.SUCCESS]
+        total_bytes = sum(row.bytes for row in succeeded)
+
+        return {
+            'jobs': options['jobs'],
+            'file_bytes': size,
+            'worker_concurrency': options['concurrency'],
+            'limits': options['with_limits'],
+            'failed': len(rows) - len(succeeded),
+            'submit_latency_seconds': summarize(submit),
+            'queue_wait_seconds': summarize([(row.started - row.created).total_seconds() for row in rows if row.started]),
+            'download_seconds': summarize([(row.finished - row.started).total_seconds() for row in succeeded]),
+            'download_throughput': {
+                'per_task_bytes_per_second': summarize([row.throughput for row in succeeded if row.throughput]),
+                'aggregate_bytes_per_second': total_bytes / wall,
+                'wall_seconds': wall,
+            },
+            'status_rps': {
+                'single': asyncio.run(self.status_rps(task_ids, options['status_requests'])),
+                'bulk': self.bulk_status_rps(client, task_ids, options['status_requests']),
+            },
+            'file_serving': asyncio.run(self.file_serving([row.task_id for row in succeeded])),
+        }
+
+    async def status_rps(self, task_ids, count):
+        """Requests per second to the async status view, in one event loop as under ASGI"""
+        client = AsyncClient()
+        begin = time.perf_counter()
+        for index in range(count):
+            await client.get(f'/api/download/status/{task_ids[index % len(task_ids)]}/')
+        return count / (time.perf_counter() - begin)
+
+    def bulk_status_rps(self, client, task_ids, count):
+        """Bulk requests per second, each asking for every task of the run"""
+        body = json.dumps({'task_ids': task_ids})
+        begin = time.perf_counter()
+        for _ in range(count):
+            client.post('/api/download/status/', body, content_type='application/json')
+        return count / (time.perf_counter() - begin)
+
+    async def file_serving(self, task_ids):
+        client = AsyncClient()
+        timings = []
+        sent = 0
+        for task_id in task_ids:
+            begin = time.perf_counter()
+            response = await client.get(f'/api/download/file/{task_id}/')
+            if response.streaming:
+                sent += sum([len(chunk) async for chunk in response.streaming_content])
+            else:
+                sent += len(response.content)
+            response.close()
+            timings.append(time.perf_counter() - begin)
+        return {
+            'request_seconds': summarize(timings),
+            'bytes_per_second': sent / sum(timings) if timings else None,
+        }
+
+    def clean_up(self, task_ids, domain):
+        """Remove the run's files, cache entries, history rows and tuning stats"""
+        get_redis().delete(tuning.STATS_PREFIX + domain)
+        for row in Download.objects.filter(task_id__in=task_ids):
+            cache.drop(row.key, remove_file=True)
+            if row.file_path:
+                quota.remove(row.file_path)
+        for task_id in task_ids:
+            shutil.rmtree(quota.task_dir(task_id), ignore_errors=True)
+        Download.objects.filter(task_id__in=task_ids).delete()
@@ -0,0 +1,73 @@
+import json
+import os
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory, override_settings
+from django.conf import settings
+
+from downloader.serving import serve_file
+
+MODES = ['django', 'x-accel-redirect', 'x-sendfile']
+
+
+class Command(BaseCommand):
+    help = 'Compare how long each FILE_SERVING mode keeps a worker busy per download'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size-mb', type=int, default=256, help='Size of the synthetic file')
+        parser.add_argument('--requests', type=int, default=5, help='Requests per mode and request kind')
+        parser.add_argument('--output', help='Write the results as JSON to this file')
+
+    def handle(self, *args, **options):
+        size = options['size_mb'] * 1024 * 1024
+        downloads_dir = os.path.join(settings.BASE_DIR, 'downloads')
+        os.makedirs(downloads_dir, exist_ok=True)
+
+        with tempfile.NamedTemporaryFile(dir=downloads_dir, suffix='.mp4') as f:
+            block = os.urandom(1024 * 1024)
+            for _ in range(options['size_mb']):
+                f.write(block)
+            f.flush()
+
+            kinds = {
+                'full': {},
+                'range_1mb': {'HTTP_RANGE': f'bytes={size - 1024 * 1024}-'},
+                'multi_range': {'HTTP_RANGE': 'bytes=0-65535,1048576-1114111,-65536'},
+            }
+            results = {}
+            for mode in MODES:
+                config = dict(settings.VIDEO_DOWNLOADER, FILE_SERVING=mode)
+                with override_settings(VIDEO_DOWNLOADER=config):
+                    results[mode] = {
+                        kind: self.measure(f.name, headers, options['requests'])
+                        for kind, headers in kinds.items()
+                    }
+
+        report = {'file_bytes': size, 'requests': options['requests'], 'modes': results}
+        self.stdout.write(json.dumps(report, indent=2))
+        if options['output']:
+            with open(options['output'], 'w') as out:
+                json.dump(report, out, indent=2)
+
+    def measure(self, file_path, headers, count):
+        """Seconds a worker spends building and sending one response, like a WSGI server would"""
+        factory = RequestFactory()
+        timings = []
+        sent = 0
+        for _ in range(count):
+            request = factory.get('/api/download/file/bench/', **headers)
+            start = time.perf_counter()
+            response = serve_file(request, file_path, os.path.basename(file_path))
+            body = response.streaming_content if response.streaming else [response.content]
+            sent = sum(len(chunk) for chunk in body)
+            response.close()
+            timings.append(time.perf_counter() - start)
+        timings.sort()
+        return {
+            'status': response.status_code,
+            'bytes_from_worker': sent,
+            'median_seconds': timings[len(timings) // 2],
+            'max_seconds': timings[-1],
+        }
@@ -0,0 +1,26 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from downloader.routing import worker_concurrency
+
+
+class Command(BaseCommand):
+    help = 'Print one celery worker command per download queue, sized by the QUEUES weights'
+
+    def handle(self, *args, **options):
+        for queue, concurrency in worker_concurrency().items():
+            name = queue.replace('.', '-')
+            self.stdout.write(
+                f'celery -A videodownload worker -Q {queue} -c {concurrency} '
+                f'--prefetch-multiplier 1 -n {name}@%h'
+            )
+        # ffmpeg is CPU-bound, so audio extraction gets one process per core and its own queue
+        config = settings.VIDEO_DOWNLOADER
+        self.stdout.write(
+            f"celery -A videodownload worker -Q {config['TRANSCODE_QUEUE']} "
+            f"-c {config['TRANSCODE_CONCURRENCY']} --prefetch-multiplier 1 -n transcode@%h"
+        )
+        # Batch expansion and storage maintenance use the default queue
+        self.stdout.write(
+            f'celery -A videodownload worker -Q {settings.CELERY_TASK_DEFAULT_QUEUE} -c 1 -n default@%h'
+        )
@@ -0,0 +1,150 @@
+"""Page metadata (title, thumbnail, duration, formats) without downloading anything.
+
+extract_info(download=False) results are cached for INFO_CACHE['TTL'] seconds, keyed
+like the media cache, and a download of the same page processes the cached info
+instead of extracting it again.
+"""
+import json
+import random
+import time
+
+from celery.utils import uuid
+from django.conf import settings
+
+from . import limiter, metrics, pool
+from .keys import extra_extractor, media_key
+from .redis_client import get_redis
+
+# Entries live in one hash so the byte counter never drifts from a TTL expiry
+ENTRIES_KEY = 'downloader:info:entries'  # key -> JSON info dict
+CREATED_KEY = 'downloader:info:created'  # key -> time the page was extracted
+BYTES_KEY = 'downloader:info:bytes'
+
+def info_key(url):
+    return media_key(url, 'info', '')
+
+def lookup(url):
+    """The cached info dict for a URL, or None on a miss"""
+    info = find(info_key(url))
+    metrics.inc('downloader_info_lookups_total', result='hit' if info else 'miss')
+    return info
+
+def find(key):
+    pipe = get_redis().pipeline(transaction=False)
+    pipe.hget(ENTRIES_KEY, key)
+    pipe.zscore(CREATED_KEY, key)
+    raw, created = pipe.execute()
+    if raw is None:
+        return None
+    if created is None or time.time() - created > settings.VIDEO_DOWNLOADER['INFO_CACHE']['TTL']:
+        drop(key)
+        return None
+    return json.loads(raw)
+
+def store(url, info):
+    config = settings.VIDEO_DOWNLOADER['INFO_CACHE']
+    data = json.dumps(info)  # ASCII only, so its length is what Redis stores
+    if len(data) > config['MAX_BYTES']:
+        return
+    key = info_key(url)
+    r = get_redis()
+    previous = r.hstrlen(ENTRIES_KEY, key)
+    pipe = r.pipeline()
+    pipe.hset(ENTRIES_KEY, key, data)
+    pipe.zadd(CREATED_KEY, {key: time.time()})
+    pipe.incrby(BYTES_KEY, len(data) - previous)
+    pipe.execute()
+    evict()
+
+def drop(key):
+    pipe = get_redis().pipeline()
+    pipe.hstrlen(ENTRIES_KEY, key)
+    pipe.hdel(ENTRIES_KEY, key)
+    pipe.zrem(CREATED_KEY, key)
+    size, removed, _ = pipe.execute()
+    if removed:
+        get_redis().decrby(BYTES_KEY, size)
+
+def forget(url):
+    """Drop a URL's info, e.g. after its format URLs stopped working"""
+    drop(info_key(url))
+
+def evict():
+    """Drop expired entries, then the oldest ones over MAX_BYTES"""
+    r = get_redis()
+    config = settings.VIDEO_DOWNLOADER['INFO_CACHE']
+    for key in r.zrangebyscore(CREATED_KEY, '-inf', time.time() - config['TTL']):
+        drop(key)
+    while int(r.get(BYTES_KEY) or 0) > config['MAX_BYTES']:
+        oldest = r.zpopmin(CREATED_KEY)
+        if not oldest:
+            break
+        drop(oldest[0][0])
+
+def extract(url):
+    """Extract a page with a pooled context, as a JSON-safe dict"""
+    # tasks imports this module for the cached info
+    from .tasks import USER_AGENTS, base_options, extract_domain, get_headers, get_referer
+
+    user_agent = random.choice(USER_AGENTS)
+    options = {
+        'user_agent': user_agent,
+        'referer': get_referer(url),
+        'headers': get_headers(user_agent),
+        'extract_flat': 'in_playlist',  # a playlist preview lists its entries without extracting each
+    }
+    extra = extra_extractor(url)
+    with metrics.span('info'), pool.borrow(extract_domain(url), 'info', base_options('video'), options) as (ydl, _):
+        info = ydl.extract_info(url, download=False, ie_key=extra.ie_key() if extra else None)
+        # Like an --info-json file: without the format selection, so a download can make its own.
+        # Playlists keep their entries for the preview.
+        return ydl.sanitize_info(info, remove_private_keys=info.get('_type', 'video') == 'video')
+
+def fetch(url):
+    """Info for a URL from the cache, extracting and caching it on a miss.
+
+    An extraction hits the site like a download does, so it takes one of the domain's
+    tokens and holds a concurrency lease while it runs; raises RateLimited if it can't.
+    """
+    from .dispatch import take_limits
+    from .tasks import extract_domain
+
+    info = lookup(url)
+    if info is None:
+        domain = extract_domain(url)
+        lease = uuid()
+        take_limits(domain, lease)
+        try:
+            info = extract(url)
+        finally:
+            limiter.release(domain, lease)
+        store(url, info)
+    return info
+
+def summary(info):
+    """The parts of an info dict a client needs to decide what to download"""
+    if info.get('_type') == 'playlist':
+        return {
+            'type': 'playlist',
+            'title': info.get('title'),
+            'uploader': info.get('uploader'),
+            'entries': [{'title': entry.get('title'), 'url': entry.get('url')} for entry in info.get('entries') or []],
+        }
+    return {
+        'type': 'video',
+        'title': info.get('title'),
+        'thumbnail': info.get('thumbnail'),
+        'duration': info.get('duration'),
+        'uploader': info.get('uploader'),
+        'formats': [{
+            'format_id': f.get('format_id'),
+            'ext': f.get('ext'),
+            'resolution': f.get('resolution'),
+            'fps': f.get('fps'),
+            'vcodec': f.get('vcodec'),
+            'acodec': f.get('acodec'),
+            'filesize': f.get('filesize') or f.get('filesize_approx'),
+            'tbr': f.get('tbr'),
+            'note': f.get('format_note'),
+        } for f in info.get('formats') or []],
+    }
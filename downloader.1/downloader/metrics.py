@@ -0,0 +1,186 @@
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.utils.decorators import sync_and_async_middleware
+
+from .redis_client import get_redis
+
+# Shared totals: one hash field per series, e.g. 'downloader_cache_lookups_total{result="hit"}'
+METRICS_KEY = 'downloader:metrics'
+
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+THROUGHPUT_BUCKETS = tuple(2 ** power for power in range(16, 31))  # 64 KB/s .. 1 GB/s
+
+LABEL_RE = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+# name -> (type, help, histogram buckets)
+METRICS = {
+    'downloader_stage_seconds': ('histogram', 'Time spent per stage of a download task', STAGE_BUCKETS),
+    'downloader_request_seconds': ('histogram', 'Time to build a response per view', STAGE_BUCKETS),
+    'downloader_download_throughput_bytes_per_second': (
+        'histogram', 'Transfer speed per finished download', THROUGHPUT_BUCKETS),
+    'downloader_download_bytes_total': ('counter', 'Bytes transferred by finished downloads', None),
+    'downloader_download_seconds_total': ('counter', 'Seconds spent transferring those bytes', None),
+    'downloader_downloads_total': ('counter', 'Finished download tasks by outcome', None),
+    'downloader_submissions_total': ('counter', 'Download requests by how they were handled', None),
+    'downloader_cache_lookups_total': ('counter', 'Media cache lookups', None),
+    'downloader_info_lookups_total': ('counter', 'Page metadata cache lookups', None),
+    'downloader_rate_limited_total': ('counter', 'Requests refused with 429', None),
+    'downloader_overloaded_total': ('counter', 'Requests refused with 503 by queue admission control', None),
+    'downloader_deferrals_total': ('counter', 'Tasks re-enqueued to respect per-domain spacing', None),
+    'downloader_aborted_total': ('counter', 'Downloads stopped by the stall watchdog or time limit', None),
+}
+
+# Updates are summed in process and written to Redis every METRICS_FLUSH_INTERVAL seconds
+_pending = {}
+_last_flush = time.monotonic()
+_lock = threading.Lock()
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def series(name, labels, escaped=False):
+    if not labels:
+        return name
+    pairs = ((k, v if escaped else escape(v)) for k, v in sorted(labels.items()))
+    return name + '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+def _add(field, amount):
+    _pending[field] = _pending.get(field, 0) + amount
+
+def inc(name, amount=1, **labels):
+    with _lock:
+        _add(series(name, labels), amount)
+    maybe_flush()
+
+def observe(name, value, **labels):
+    """Record a histogram sample"""
+    buckets = METRICS[name][2]
+    with _lock:
+        for bound in buckets:
+            if value <= bound:
+                _add(series(name + '_bucket', dict(labels, le=bound)), 1)
+        _add(series(name + '_bucket', dict(labels, le='+Inf')), 1)
+        _add(series(name + '_sum', labels), value)
+        _add(series(name + '_count', labels), 1)
+    maybe_flush()
+
+@contextmanager
+def span(stage, **labels):
+    """Time a block as one stage of the download pipeline"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe('downloader_stage_seconds', time.perf_counter() - start, stage=stage, **labels)
+
+def maybe_flush():
+    if time.monotonic() - _last_flush >= settings.VIDEO_DOWNLOADER['METRICS_FLUSH_INTERVAL']:
+        flush()
+
+def flush():
+    """Add this process's pending updates to the shared totals with one pipeline"""
+    global _pending, _last_flush
+    with _lock:
+        pending, _pending, _last_flush = _pending, {}, time.monotonic()
+    if not pending:
+        return
+    pipe = get_redis().pipeline(transaction=False)
+    for field, amount in pending.items():
+        pipe.hincrbyfloat(METRICS_KEY, field, amount)
+    pipe.execute()
+
+def make_stage_hook(marks):
+    """yt-dlp progress hook noting when the transfer starts and when each file finishes"""
+    def hook(d):
+        now = time.perf_counter()
+        if d['status'] == 'downloading':
+            marks.setdefault('transfer', now)
+        elif d['status'] == 'finished':
+            marks.setdefault('transfer', now)
+            marks['finished'] = now
+    return hook
+
+def observe_run(marks, start, end, **labels):
+    """Split one yt-dlp run into extract, transfer and postprocess stages"""
+    transfer = marks.get('transfer', end)
+    finished = marks.get('finished', end)
+    observe('downloader_stage_seconds', transfer - start, stage='extract', **labels)
+    if 'finished' in marks:
+        observe('downloader_stage_seconds', finished - transfer, stage='transfer', **labels)
+        # Merging formats and other postprocessors run after the last file finished
+        observe('downloader_stage_seconds', end - finished, stage='postprocess', **labels)
+
+def observe_throughput(domain, size, seconds):
+    if size <= 0 or seconds <= 0:
+        return
+    inc('downloader_download_bytes_total', size, domain=domain)
+    inc('downloader_download_seconds_total', seconds, domain=domain)
+    observe('downloader_download_throughput_bytes_per_second', size / seconds, domain=domain)
+
+def format_value(value):
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+def histogram_lines(name, buckets, fields):
+    """Every bucket of every label set in order, including the ones nothing has landed in"""
+    lines = []
+    for count_field in sorted(field for field in fields if field.startswith(name + '_count')):
+        labels = dict(LABEL_RE.findall(count_field))
+        for bound in [*buckets, '+Inf']:
+            bucket = series(name + '_bucket', dict(labels, le=bound), escaped=True)
+            lines.append(f'{bucket} {format_value(fields.get(bucket, 0))}')
+        for suffix in ('_sum', '_count'):
+            field = series(name + suffix, labels, escaped=True)
+            lines.append(f'{field} {format_value(fields.get(field, 0))}')
+    return lines
+
+def render(gauges=()):
+    """Prometheus text exposition of the shared totals plus (name, help, {labels: value}) gauges"""
+    totals = get_redis().hgetall(METRICS_KEY)
+    lines = []
+    for name, (kind, help_text, buckets) in METRICS.items():
+        names = {name, name + '_bucket', name + '_sum', name + '_count'}
+        fields = {field: value for field, value in totals.items() if field.split('{', 1)[0] in names}
+        if not fields:
+            continue
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        if kind == 'histogram':
+            lines.extend(histogram_lines(name, buckets, fields))
+        else:
+            lines.extend(f'{field} {format_value(value)}' for field, value in sorted(fields.items()))
+    for name, help_text, values in gauges:
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} gauge')
+        lines.extend(f'{series(name, labels)} {format_value(value)}' for labels, value in values)
+    return '\n'.join(lines) + '\n'
+
+def observe_request(request, response, start):
+    match = request.resolver_match
+    observe(
+        'downloader_request_seconds', time.perf_counter() - start,
+        view=match.url_name if match else 'unmatched', status=response.status_code,
+    )
+
+@sync_and_async_middleware
+def timing_middleware(get_response):
+    """Time every request per view; streamed bodies are not included"""
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            start = time.perf_counter()
+            response = await get_response(request)
+            observe_request(request, response, start)
+            return response
+        markcoroutinefunction(middleware)
+    else:
+        def middleware(request):
+            start = time.perf_counter()
+            response = get_response(request)
+            observe_request(request, response, start)
+            return response
+    return middleware
@@ -0,0 +1,39 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:21
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Download',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('task_id', models.CharField(max_length=64, unique=True)),
+                ('url', models.TextField()),
+                ('key', models.CharField(max_length=40)),
+                ('domain', models.CharField(max_length=255)),
+                ('media_type', models.CharField(max_length=10)),
+                ('state', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('success', 'Success'), ('failed', 'Failed')], default='queued', max_length=10)),
+                ('cached', models.BooleanField(default=False)),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('started', models.DateTimeField(blank=True, null=True)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+                ('bytes', models.BigIntegerField(default=0)),
+                ('file_path', models.TextField(blank=True)),
+                ('filename', models.TextField(blank=True)),
+                ('title', models.TextField(blank=True)),
+                ('error', models.TextField(blank=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['key'], name='downloader__key_e4c7b6_idx'), models.Index(fields=['domain', 'created'], name='downloader__domain_ad907d_idx'), models.Index(fields=['state'], name='downloader__state_159773_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('downloader', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='download',
+            name='chunk_size',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='download',
+            name='fragments',
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='download',
+            name='throughput',
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
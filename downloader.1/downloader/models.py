@@ -1,3 +1,74 @@
+from datetime import timedelta
+
 from django.db import models
+from django.db.models import Avg, Count, Sum
+from django.utils import timezone
+
+
+class DownloadQuerySet(models.QuerySet):
+    def per_domain(self, since=None):
+        """Downloads and bytes per domain, e.g. per_domain(timedelta(hours=1))"""
+        qs = self
+        if since is not None:
+            qs = qs.filter(created__gte=timezone.now() - since)
+        return qs.values('domain').annotate(downloads=Count('id'), bytes=Sum('bytes')).order_by('-downloads')
+
+    def per_tuning(self, since=None):
+        """Average throughput per domain and fragment level, to check whether the tuning helps"""
+        qs = self.filter(throughput__isnull=False)
+        if since is not None:
+            qs = qs.filter(created__gte=timezone.now() - since)
+        return qs.values('domain', 'fragments').annotate(
+            downloads=Count('id'), throughput=Avg('throughput'), chunk_size=Avg('chunk_size'),
+        ).order_by('domain', 'fragments')
+
+    def recent_success(self, key, max_age):
+        """Newest finished download for a media key, if it is younger than max_age seconds"""
+        return self.filter(
+            key=key, state=Download.SUCCESS, finished__gte=timezone.now() - timedelta(seconds=max_age),
+        ).order_by('-finished').first()
+
+
+class Download(models.Model):
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCESS = 'success'
+    FAILED = 'failed'
+    STATE_CHOICES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (SUCCESS, 'Success'),
+        (FAILED, 'Failed'),
+    ]
+
+    task_id = models.CharField(max_length=64, unique=True)
+    url = models.TextField()
+    key = models.CharField(max_length=40)  # media key, see downloader.keys
+    domain = models.CharField(max_length=255)
+    media_type = models.CharField(max_length=10)
+    state = models.CharField(max_length=10, choices=STATE_CHOICES, default=QUEUED)
+    cached = models.BooleanField(default=False)
+    created = models.DateTimeField(default=timezone.now)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+    bytes = models.BigIntegerField(default=0)
+    file_path = models.TextField(blank=True)
+    filename = models.TextField(blank=True)
+    title = models.TextField(blank=True)
+    error = models.TextField(blank=True)
+    # Download tuning chosen for this task and the throughput it got, see downloader.tuning
+    fragments = models.PositiveSmallIntegerField(null=True, blank=True)
+    chunk_size = models.PositiveIntegerField(null=True, blank=True)
+    throughput = models.FloatField(null=True, blank=True)  # bytes/s
+
+    objects = DownloadQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['key']),
+            models.Index(fields=['domain', 'created']),
+            models.Index(fields=['state']),
+        ]
 
-# Create your models here.
+    def __str__(self):
+        return f'{self.task_id} {self.state} {self.url}'
@@ -0,0 +1,126 @@
+"""Long-lived yt-dlp contexts per worker process, keyed by (domain, media type).
+
+A YoutubeDL keeps its extractor instances (with whatever they initialized) and its
+request handlers, whose HTTP sessions hold keep-alive connections, so a task that
+borrows a warm context skips that setup. Contexts are checked out exclusively,
+pointed at the task's output and hooks, and closed instead of returned after any
+error or once they have served MAX_USES tasks.
+"""
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import yt_dlp
+from django.conf import settings
+
+from . import metrics
+from .keys import extra_extractors
+
+_idle = OrderedDict()  # (domain, media_type) -> [(context, uses)], least recently returned first
+_lock = threading.Lock()
+
+def build(base):
+    """A new context from build-time options (format, timeouts, extractor args)"""
+    ydl = yt_dlp.YoutubeDL(dict(base))
+    # Custom extractors are registered once per context; tasks select them by ie_key
+    for ie in extra_extractors():
+        ydl.add_info_extractor(ie())
+    return ydl
+
+def configure(ydl, options):
+    """Point a context at one task: its output template, hooks and tuning options.
+
+    YoutubeDL reads the output template and hooks only in __init__, so they are
+    re-applied here through its private attributes. Those can change in any
+    release, so requirements.txt pins yt-dlp to an exact version; check this
+    function before moving the pin.
+    """
+    ydl.params.update(options)
+    ydl._parse_outtmpl()
+    ydl._progress_hooks = []
+    ydl._post_hooks = []
+    for hook in options.get('progress_hooks', []):
+        ydl.add_progress_hook(hook)
+    for hook in options.get('post_hooks', []):
+        ydl.add_post_hook(hook)
+    ydl._download_retcode = 0
+    ydl._num_downloads = 0
+
+def release(ydl):
+    """Drop the finished task's hooks so the idle context doesn't keep them alive"""
+    ydl._progress_hooks = []
+    ydl._post_hooks = []
+    for name in ('progress_hooks', 'post_hooks'):
+        ydl.params.pop(name, None)
+
+def take(key):
+    with _lock:
+        contexts = _idle.get(key)
+        if not contexts:
+            return None
+        context = contexts.pop()
+        if not contexts:
+            del _idle[key]
+        return context
+
+def give_back(key, ydl, uses):
+    config = settings.VIDEO_DOWNLOADER['POOL']
+    closing = []
+    with _lock:
+        contexts = _idle.setdefault(key, [])
+        if uses >= config['MAX_USES'] or len(contexts) >= config['MAX_IDLE']:
+            closing.append(ydl)
+        else:
+            contexts.append((ydl, uses))
+            _idle.move_to_end(key)
+        # Past the process-wide limit, the contexts of the least recently used keys go first
+        while sum(len(idle) for idle in _idle.values()) > config['MAX_CONTEXTS']:
+            oldest = next(iter(_idle))
+            closing.append(_idle[oldest].pop(0)[0])
+            if not _idle[oldest]:
+                del _idle[oldest]
+        if not contexts:
+            _idle.pop(key, None)
+    for context in closing:
+        context.close()
+
+@contextmanager
+def borrow(domain, media_type, base, options):
+    """A YoutubeDL for one task, warm if this process has an idle one for the key.
+
+    Yields (ydl, 'warm' or 'cold'); the time to get it ready is recorded as the
+    'setup' stage.
+    """
+    key = (domain, media_type)
+    started = time.perf_counter()
+    context = take(key)
+    if context:
+        ydl, uses = context
+        state = 'warm'
+    else:
+        ydl, uses = build(base), 0
+        state = 'cold'
+    configure(ydl, options)
+    metrics.observe('downloader_stage_seconds', time.perf_counter() - started, stage='setup', context=state)
+
+    try:
+        yield ydl, state
+    except BaseException:
+        # Half-finished downloads can leave handlers or extractor state in a bad way
+        ydl.close()
+        raise
+    release(ydl)
+    give_back(key, ydl, uses + 1)
+
+def warm(base_options):
+    """Build the WARM contexts; base_options(media_type) gives their build-time options"""
+    for domain, media_type in settings.VIDEO_DOWNLOADER['POOL']['WARM']:
+        give_back((domain, media_type), build(base_options(media_type)), 0)
+
+def close_all():
+    with _lock:
+        contexts = [ydl for idle in _idle.values() for ydl, _ in idle]
+        _idle.clear()
+    for ydl in contexts:
+        ydl.close()
@@ -0,0 +1,120 @@
+import json
+import os
+import time
+
+from asgiref.sync import sync_to_async
+from celery.result import AsyncResult
+from django.conf import settings
+from yt_dlp.utils import sanitize_filename
+
+from . import history, quota
+from .redis_client import get_async_redis, get_redis
+from .storage import get_storage
+
+CHANNEL_PREFIX = 'downloader:progress:'
+SNAPSHOT_PREFIX = 'downloader:progress:last:'
+OUTPUT_PREFIX = 'downloader:progress:output:'  # file being written, kept server-side
+TERMINAL_STATES = ('success', 'error')
+
+def publish(task_id, payload):
+    """Send a progress update to subscribers and keep it as the latest snapshot"""
+    data = json.dumps(payload)
+    pipe = get_redis().pipeline()
+    pipe.set(SNAPSHOT_PREFIX + task_id, data, ex=settings.VIDEO_DOWNLOADER['PROGRESS_TTL'])
+    pipe.publish(CHANNEL_PREFIX + task_id, data)
+    pipe.execute()
+
+def make_progress_hook(task_id):
+    """yt-dlp progress hook that publishes bytes, speed and ETA for a task"""
+    interval = settings.VIDEO_DOWNLOADER['PROGRESS_INTERVAL']
+    last_sent = [0.0]
+    last_output = [None]
+
+    def hook(d):
+        # Merged formats are written to several files and joined at the end,
+        # so only single-file downloads can be followed while they grow. With remote
+        # storage the file is on the worker's disk, out of the web nodes' reach
+        streamable = not d.get('info_dict', {}).get('requested_formats') and not get_storage().remote
+        if d.get('tmpfilename') and d['tmpfilename'] != last_output[0]:
+            last_output[0] = d['tmpfilename']
+            record_output(task_id, d['tmpfilename'], d['filename'], streamable, d.get('info_dict', {}).get('title'))
+
+        now = time.monotonic()
+        # Fragments report many times a second; only forward a few of them
+        if d['status'] == 'downloading' and now - last_sent[0] < interval:
+            return
+        last_sent[0] = now
+        if d.get('downloaded_bytes'):
+            history.update(task_id, bytes=d['downloaded_bytes'])
+        publish(task_id, {
+            'state': d['status'],  # downloading / finished (one file) / error
+            'downloaded_bytes': d.get('downloaded_bytes'),
+            'total_bytes': d.get('total_bytes') or d.get('total_bytes_estimate'),
+            'speed': d.get('speed'),
+            'eta': d.get('eta'),
+            'streamable': streamable,
+        })
+    return hook
+
+def record_output(task_id, tmpfilename, filename, streamable, title=None):
+    """Remember which file a task is writing so download_file can follow it"""
+    quota.record_part_owner(tmpfilename, task_id)
+    ext = os.path.splitext(filename)[1]
+    get_redis().set(OUTPUT_PREFIX + task_id, json.dumps({
+        'tmpfilename': tmpfilename,
+        'filename': filename,
+        'download_name': sanitize_filename(title) + ext if title else os.path.basename(filename),
+        'streamable': streamable,
+    }), ex=settings.VIDEO_DOWNLOADER['PROGRESS_TTL'])
+
+async def partial_output(task_id):
+    """The file a running task is writing, or None if it can't be streamed yet"""
+    raw = await get_async_redis().get(OUTPUT_PREFIX + task_id)
+    if raw is None:
+        return None
+    output = json.loads(raw)
+    return output if output['streamable'] else None
+
+def final_event(result):
+    """Terminal progress event for a task's return value"""
+    if isinstance(result, dict) and result.get('status') == 'success':
+        return {'state': 'success'}
+    error = result.get('error') if isinstance(result, dict) else str(result)
+    return {'state': 'error', 'error': error}
+
+def publish_result(task_id, result):
+    """Publish the final state of a finished task"""
+    publish(task_id, final_event(result))
+
+def _result_event(task_id):
+    """Final event from the result backend, or None while the task is running"""
+    task = AsyncResult(task_id)
+    if not task.ready():
+        return None
+    return json.dumps(final_event(task.result))
+
+async def stream(task_id):
+    """Server-sent events for a task, ending once it succeeds or fails"""
+    client = get_async_redis()
+    keepalive = settings.VIDEO_DOWNLOADER['PROGRESS_KEEPALIVE']
+    pubsub = client.pubsub()
+    await pubsub.subscribe(CHANNEL_PREFIX + task_id)
+    try:
+        # Replay the latest state so late subscribers don't wait for the next update
+        data = await client.get(SNAPSHOT_PREFIX + task_id)
+        while True:
+            if data is None:
+                # Cache hits and long-finished tasks never publish; ask the result backend
+                # (in an executor thread, not the one shared by every sync view)
+                data = await sync_to_async(_result_event, thread_sensitive=False)(task_id)
+            if data is None:
+                yield ': keepalive\n\n'
+            else:
+                yield f'data: {data}\n\n'
+                if json.loads(data)['state'] in TERMINAL_STATES:
+                    return
+            message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=keepalive)
+            data = message['data'] if message else None
+    finally:
+        await pubsub.unsubscribe()
+        await pubsub.aclose()
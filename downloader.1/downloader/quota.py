@@ -0,0 +1,203 @@
+import json
+import os
+import time
+
+from celery import states
+from celery.result import AsyncResult
+from django.conf import settings
+
+from .redis_client import get_async_redis, get_redis
+
+FILES_KEY = 'downloader:files'          # path -> {size, task_id}
+LRU_KEY = 'downloader:files:lru'        # path -> last access time
+BYTES_KEY = 'downloader:files:bytes'
+PART_OWNER_PREFIX = 'downloader:part-owner:'
+CURSOR_KEY = 'downloader:files:cursor'  # next shard for maintain() to scan
+
+# Task output lives in downloads/<first two hex digits of the task id>/<task id>/
+SHARDS = [f'{i:02x}' for i in range(256)]
+
+def downloads_dir():
+    return os.path.join(settings.BASE_DIR, 'downloads')
+
+def task_dir(task_id):
+    """Directory a task writes its output into"""
+    return os.path.join(downloads_dir(), task_id[:2], task_id)
+
+def prune_empty_dirs(path):
+    """Remove now-empty task and shard directories above a deleted file"""
+    root = downloads_dir()
+    parent = os.path.dirname(path)
+    while parent != root and parent.startswith(root):
+        try:
+            os.rmdir(parent)
+        except OSError:
+            return
+        parent = os.path.dirname(parent)
+
+def register(file_path, task_id, last_access=None, size=None):
+    """Add a completed file to the index (pass its size once it has left this disk)"""
+    if size is None:
+        size = os.path.getsize(file_path)
+    r = get_redis()
+    previous = r.hget(FILES_KEY, file_path)
+    pipe = r.pipeline()
+    pipe.hset(FILES_KEY, file_path, json.dumps({'size': size, 'task_id': task_id}))
+    pipe.zadd(LRU_KEY, {file_path: last_access or time.time()})
+    pipe.incrby(BYTES_KEY, size - (json.loads(previous)['size'] if previous else 0))
+    pipe.execute()
+
+def touch(file_path):
+    """Mark a file as recently used so it is evicted last"""
+    get_redis().zadd(LRU_KEY, {file_path: time.time()}, xx=True)
+
+async def atouch(file_path):
+    await get_async_redis().zadd(LRU_KEY, {file_path: time.time()}, xx=True)
+
+def remove(file_path):
+    """Delete a file from storage and drop it from the index"""
+    from .storage import get_storage
+    r = get_redis()
+    pipe = r.pipeline()
+    pipe.hget(FILES_KEY, file_path)
+    pipe.hdel(FILES_KEY, file_path)
+    pipe.zrem(LRU_KEY, file_path)
+    raw, removed, _ = pipe.execute()
+    if raw and removed:
+        r.decrby(BYTES_KEY, json.loads(raw)['size'])
+    try:
+        get_storage().delete(file_path)
+        print(f"Removed file: {file_path}")
+    except OSError:
+        return
+
+def enforce():
+    """Evict least recently used files until the index fits DISK_QUOTA_BYTES"""
+    r = get_redis()
+    quota = settings.VIDEO_DOWNLOADER['DISK_QUOTA_BYTES']
+    evicted = 0
+    while int(r.get(BYTES_KEY) or 0) > quota:
+        oldest = r.zpopmin(LRU_KEY)
+        if not oldest:
+            break
+        remove(oldest[0][0])
+        evicted += 1
+    return evicted
+
+def record_part_owner(tmpfilename, task_id):
+    """Remember which task writes a .part file so cleanup can tell live from orphaned"""
+    ttl = settings.VIDEO_DOWNLOADER['PARTIAL_FILE_GRACE'] * 2
+    get_redis().set(PART_OWNER_PREFIX + tmpfilename, task_id, ex=ttl)
+
+def is_partial(name):
+    """Whether a file is yt-dlp's work in progress rather than a finished output"""
+    return name.endswith(('.part', '.ytdl')) or '.part-Frag' in name or '.temp.' in name
+
+def owner_task(path):
+    """Task id of the directory a file is in, or None for the older flat layout"""
+    relative = os.path.relpath(path, downloads_dir()).split(os.sep)
+    return relative[1] if len(relative) > 2 and relative[0] in SHARDS else None
+
+def is_live(task_id):
+    """Whether a run of the task may still write into its directory.
+
+    A running task holds its task lock, and a task between runs (deferred or
+    waiting to retry) keeps its domain's concurrency lease until its final run.
+    """
+    from .limiter import holds
+    from .models import Download
+    from .singleflight import LOCK_PREFIX
+    if get_redis().exists(LOCK_PREFIX + task_id):
+        return True
+    domain = Download.objects.filter(task_id=task_id).values_list('domain', flat=True).first()
+    return bool(domain) and holds(domain, task_id)
+
+def is_orphaned(part_path, mtime):
+    """A .part file is orphaned once its task has finished or nothing has written to it for a while"""
+    owner = get_redis().get(PART_OWNER_PREFIX + part_path)
+    if owner and AsyncResult(owner).state in states.READY_STATES:
+        return True
+    return time.time() - mtime > settings.VIDEO_DOWNLOADER['PARTIAL_FILE_GRACE']
+
+def iter_files(directory, shards):
+    """Files directly in downloads/ (older flat layout) and everything under the given shards"""
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_file():
+                yield entry.path, entry.name, entry.stat()
+    for shard in shards:
+        for root, _, filenames in os.walk(os.path.join(directory, shard)):
+            for name in filenames:
+                path = os.path.join(root, name)
+                try:
+                    yield path, name, os.stat(path)
+                except FileNotFoundError:
+                    continue
+
+def maintain():
+    """One incremental pass: index unknown finished files, remove orphaned partial files, enforce the quota"""
+    from .models import Download
+    from .storage import get_storage
+    directory = downloads_dir()
+    if not os.path.isdir(directory):
+        return {'indexed': 0, 'partials_removed': 0, 'evicted': 0}
+
+    r = get_redis()
+    config = settings.VIDEO_DOWNLOADER
+    budget = config['MAINTENANCE_BATCH']
+
+    # Walk a few shards per pass instead of the whole tree
+    cursor = int(r.get(CURSOR_KEY) or 0)
+    count = config['MAINTENANCE_SHARDS_PER_PASS']
+    shards = [SHARDS[(cursor + i) % len(SHARDS)] for i in range(count)]
+    r.set(CURSOR_KEY, (cursor + count) % len(SHARDS))
+
+    # With remote storage finished files only pass through downloads/ on their way out,
+    # so anything left behind is cleaned up like a partial file
+    scratch = get_storage().remote
+    indexed = partials_removed = 0
+    live = {}  # task id -> is_live(), once per directory
+    unknown = []
+    for path, name, stat in iter_files(directory, shards):
+        if indexed + partials_removed + len(unknown) >= budget:
+            break
+        task_id = owner_task(path)
+        if task_id:
+            if task_id not in live:
+                live[task_id] = is_live(task_id)
+            if live[task_id]:
+                # Its files are still being written, merged or resumed
+                continue
+        if not scratch and r.hexists(FILES_KEY, path):
+            continue
+        if scratch or is_partial(name):
+            if is_orphaned(path, stat.st_mtime) and discard(path):
+                partials_removed += 1
+        else:
+            unknown.append((path, task_id, stat))
+
+    # Index finished outputs recorded by a worker that crashed mid-bookkeeping (and files
+    # of the older flat layout). Anything else a task left behind, like the separate
+    # format files of an unfinished merge, is a leftover.
+    finished = set(Download.objects.filter(
+        state=Download.SUCCESS, file_path__in=[path for path, _, _ in unknown],
+    ).values_list('file_path', flat=True))
+    for path, task_id, stat in unknown:
+        if task_id is None or path in finished:
+            register(path, task_id, last_access=stat.st_atime)
+            indexed += 1
+        elif is_orphaned(path, stat.st_mtime) and discard(path):
+            partials_removed += 1
+
+    return {'indexed': indexed, 'partials_removed': partials_removed, 'evicted': enforce()}
+
+def discard(path):
+    """Remove a leftover file from downloads/; False if it couldn't be"""
+    try:
+        os.remove(path)
+    except OSError as e:
+        print(f"Failed to remove {path}: {e}")
+        return False
+    print(f"Cleaned up partial file: {path}")
+    prune_empty_dirs(path)
+    return True
@@ -0,0 +1,40 @@
+import asyncio
+
+import redis
+import redis.asyncio as aioredis
+from django.conf import settings
+
+_client = None
+_async_clients = {}  # event loop -> ({url: client}, task closing them)
+
+def redis_url():
+    return settings.VIDEO_DOWNLOADER.get('REDIS_URL') or settings.CELERY_BROKER_URL
+
+def get_redis():
+    """Shared Redis client for downloader state (defaults to the Celery broker)"""
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(redis_url(), decode_responses=True)
+    return _client
+
+def get_async_redis(url=None):
+    """Shared asyncio Redis client for async views (one per event loop and URL)"""
+    url = url or redis_url()
+    loop = asyncio.get_running_loop()
+    if loop not in _async_clients:
+        # Under WSGI every async view runs in a one-off loop; close its clients with it
+        _async_clients[loop] = ({}, loop.create_task(_close_on_shutdown()))
+    clients = _async_clients[loop][0]
+    if url not in clients:
+        clients[url] = aioredis.Redis.from_url(url, decode_responses=True)
+    return clients[url]
+
+async def _close_on_shutdown():
+    """Wait until the running loop cancels its tasks on shutdown, then close the loop's clients"""
+    loop = asyncio.get_running_loop()
+    try:
+        await loop.create_future()
+    finally:
+        clients, _ = _async_clients.pop(loop)
+        for client in clients.values():
+            await client.aclose()
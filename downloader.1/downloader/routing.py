@@ -0,0 +1,65 @@
+from django.conf import settings
+
+from videodownload.celery import app
+
+DOWNLOAD_TASK = 'downloader.tasks.download_video_task'
+TRANSCODE_TASK = 'downloader.tasks.extract_audio_task'
+
+
+def route_for(url, media_type):
+    """(queue, priority) for a download: the first QUEUES entry matching its domain and media type"""
+    from .tasks import extract_domain
+
+    domain = extract_domain(url)
+    for queue, rule in settings.VIDEO_DOWNLOADER['QUEUES'].items():
+        if rule.get('domains') and domain not in rule['domains']:
+            continue
+        if rule.get('media_types') and media_type not in rule['media_types']:
+            continue
+        return queue, rule.get('priority', settings.CELERY_TASK_DEFAULT_PRIORITY)
+    return settings.CELERY_TASK_DEFAULT_QUEUE, settings.CELERY_TASK_DEFAULT_PRIORITY
+
+
+def route_download(name, args, kwargs, options, task=None, **kw):
+    """Celery router (see CELERY_TASK_ROUTES); options passed to apply_async still win"""
+    if name == TRANSCODE_TASK:
+        return {'queue': settings.VIDEO_DOWNLOADER['TRANSCODE_QUEUE']}
+    if name != DOWNLOAD_TASK:
+        return None
+    url = args[0] if args else kwargs['url']
+    media_type = args[1] if len(args) > 1 else kwargs['download_type']
+    queue, priority = route_for(url, media_type)
+    return {'queue': queue, 'priority': priority}
+
+
+def worker_concurrency():
+    """Download slots per queue: WORKER_CONCURRENCY split by each queue's weight"""
+    config = settings.VIDEO_DOWNLOADER
+    queues = config['QUEUES']
+    total_weight = sum(rule.get('weight', 1) for rule in queues.values())
+    return {
+        queue: max(1, round(config['WORKER_CONCURRENCY'] * rule.get('weight', 1) / total_weight))
+        for queue, rule in queues.items()
+    }
+
+def queue_names():
+    config = settings.VIDEO_DOWNLOADER
+    return [settings.CELERY_TASK_DEFAULT_QUEUE, *config['QUEUES'], config['TRANSCODE_QUEUE']]
+
+def priority_depths(queues=None):
+    """Messages waiting per queue and priority step, with one LLEN per broker sub-queue"""
+    options = settings.CELERY_BROKER_TRANSPORT_OPTIONS
+    sep = options.get('sep', '\x06\x16')
+    steps = options['priority_steps']
+    queues = queues or queue_names()
+    with app.pool.acquire(block=True) as connection:
+        pipe = connection.default_channel.client.pipeline(transaction=False)
+        for queue in queues:
+            for priority in steps:
+                pipe.llen(f'{queue}{sep}{priority}' if priority else queue)
+        lengths = iter(pipe.execute())
+    return {queue: {priority: next(lengths) for priority in steps} for queue in queues}
+
+def queue_depths():
+    """Messages waiting per queue, summed over the broker's priority sub-queues"""
+    return {queue: sum(depths.values()) for queue, depths in priority_depths().items()}
@@ -1,5 +1,31 @@
+from django.conf import settings
 from rest_framework import serializers
 
 class DownloadRequestSerializer(serializers.Serializer):
     url = serializers.URLField()
     media_type = serializers.ChoiceField(choices=['video', 'audio'])
+
+class BatchDownloadRequestSerializer(serializers.Serializer):
+    urls = serializers.ListField(child=serializers.CharField(), allow_empty=False)
+    media_type = serializers.ChoiceField(choices=['video', 'audio'])
+    audio_format = serializers.ChoiceField(choices=list(settings.VIDEO_DOWNLOADER['AUDIO_FORMATS']), required=False)
+
+    def validate_urls(self, value):
+        limit = settings.VIDEO_DOWNLOADER['MAX_BATCH_SIZE']
+        if len(value) > limit:
+            raise serializers.ValidationError(f'At most {limit} URLs per batch.')
+        return value
+
+class BulkStatusRequestSerializer(serializers.Serializer):
+    task_ids = serializers.ListField(child=serializers.CharField(max_length=64), allow_empty=False)
+    known = serializers.DictField(child=serializers.CharField(), required=False, default=dict)
+    wait = serializers.FloatField(min_value=0, required=False, default=0)
+
+    def validate_task_ids(self, value):
+        limit = settings.VIDEO_DOWNLOADER['BULK_STATUS_MAX_IDS']
+        if len(value) > limit:
+            raise serializers.ValidationError(f'At most {limit} task IDs per request.')
+        return list(dict.fromkeys(value))
+
+    def validate_wait(self, value):
+        return min(value, settings.VIDEO_DOWNLOADER['BULK_STATUS_MAX_WAIT'])
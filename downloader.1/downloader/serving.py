@@ -0,0 +1,182 @@
+import asyncio
+import os
+import re
+import mimetypes
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.crypto import get_random_string
+from django.utils.http import content_disposition_header, http_date, parse_http_date_safe
+
+from .quota import downloads_dir
+
+RANGE_RE = re.compile(r'^\s*(\d*)\s*-\s*(\d*)\s*$')
+MAX_RANGES = 16  # More ranges than this is more likely abuse than a media player
+
+def file_etag(stat):
+    """Strong ETag from size and modification time (files are never rewritten in place)"""
+    return f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+
+def parse_ranges(header, size):
+    """Parse a Range header into sorted, merged (start, end) pairs.
+
+    Returns None when the header should be ignored and [] when no range is satisfiable.
+    """
+    if not header or not header.startswith('bytes=') or size == 0:
+        return None
+    ranges = []
+    for spec in header[len('bytes='):].split(','):
+        match = RANGE_RE.match(spec)
+        if not match or match.groups() == ('', ''):
+            return None
+        first, last = match.groups()
+        if first == '':
+            # Suffix range: the last N bytes
+            start, end = max(size - int(last), 0), size - 1
+        else:
+            start = int(first)
+            if last and int(last) < start:
+                return None
+            end = min(int(last), size - 1) if last else size - 1
+        if start < size and start <= end:
+            ranges.append((start, end))
+    if len(ranges) > MAX_RANGES:
+        return None
+
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+def iter_range(file_path, start, end, chunk_size):
+    """Yield bytes start..end (inclusive) of a file"""
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                return
+            remaining -= len(chunk)
+            yield chunk
+
+def iter_multipart(file_path, ranges, size, content_type, boundary, chunk_size):
+    for start, end in ranges:
+        yield (
+            f'--{boundary}\r\n'
+            f'Content-Type: {content_type}\r\n'
+            f'Content-Range: bytes {start}-{end}/{size}\r\n\r\n'
+        ).encode('ascii')
+        yield from iter_range(file_path, start, end, chunk_size)
+        yield b'\r\n'
+    yield f'--{boundary}--\r\n'.encode('ascii')
+
+async def in_thread(iterator):
+    """Drive a blocking iterator from the event loop, each step in the default executor"""
+    done = object()
+    try:
+        while (chunk := await asyncio.to_thread(next, iterator, done)) is not done:
+            yield chunk
+    finally:
+        iterator.close()
+
+def multipart_length(ranges, size, content_type, boundary):
+    length = len(f'--{boundary}--\r\n')
+    for start, end in ranges:
+        length += len(
+            f'--{boundary}\r\n'
+            f'Content-Type: {content_type}\r\n'
+            f'Content-Range: bytes {start}-{end}/{size}\r\n\r\n'
+        ) + (end - start + 1) + 2
+    return length
+
+def if_range_matches(request, etag, mtime):
+    """Whether a Range request may be honoured under its If-Range precondition"""
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if not if_range:
+        return True
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        return if_range == etag
+    since = parse_http_date_safe(if_range)
+    return since is not None and int(mtime) <= since
+
+def offload_path(file_path):
+    """Path under the proxy's internal location for a file in downloads/"""
+    relative = os.path.relpath(file_path, downloads_dir()).replace(os.sep, '/')
+    return settings.VIDEO_DOWNLOADER['X_ACCEL_REDIRECT_PREFIX'] + quote(relative)
+
+def serve_file(request, file_path, filename):
+    """Send a finished download using the configured FILE_SERVING backend.
+
+    'django' streams from the worker with Range and conditional request support;
+    'x-accel-redirect' (nginx) and 'x-sendfile' (Apache, lighttpd) only send headers
+    and let the front proxy move the bytes, ranges included. Under ASGI the body is
+    read in executor threads rather than the single thread Django's ASGI handler
+    would use to iterate every sync body.
+    """
+    config = settings.VIDEO_DOWNLOADER
+    asynchronous = isinstance(request, ASGIRequest)
+    stat = os.stat(file_path)
+    etag = file_etag(stat)
+    content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+    validators = HttpResponse()
+    validators['ETag'] = etag
+    validators['Last-Modified'] = http_date(stat.st_mtime)
+    conditional = get_conditional_response(request, etag=etag, last_modified=int(stat.st_mtime), response=validators)
+    if conditional is not validators:
+        return conditional
+
+    mode = config['FILE_SERVING']
+    ranges = None
+    if mode == 'x-accel-redirect':
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = offload_path(file_path)
+    elif mode == 'x-sendfile':
+        response = HttpResponse(content_type=content_type)
+        response['X-Sendfile'] = file_path
+    else:
+        if if_range_matches(request, etag, stat.st_mtime):
+            ranges = parse_ranges(request.META.get('HTTP_RANGE'), stat.st_size)
+
+        if ranges is None and asynchronous:
+            response = StreamingHttpResponse(
+                in_thread(iter_range(file_path, 0, stat.st_size - 1, config['STREAM_CHUNK_SIZE'])),
+                content_type=content_type,
+            )
+            response['Content-Length'] = str(stat.st_size)
+        elif ranges is None:
+            # Whole file: FileResponse hands the file to wsgi.file_wrapper (sendfile) when available
+            response = FileResponse(open(file_path, 'rb'), content_type=content_type)
+        elif not ranges:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{stat.st_size}'
+            return response
+        elif len(ranges) == 1:
+            start, end = ranges[0]
+            body = iter_range(file_path, start, end, config['STREAM_CHUNK_SIZE'])
+            response = StreamingHttpResponse(
+                in_thread(body) if asynchronous else body, status=206, content_type=content_type,
+            )
+            response['Content-Range'] = f'bytes {start}-{end}/{stat.st_size}'
+            response['Content-Length'] = str(end - start + 1)
+        else:
+            boundary = get_random_string(24)
+            body = iter_multipart(file_path, ranges, stat.st_size, content_type, boundary, config['STREAM_CHUNK_SIZE'])
+            response = StreamingHttpResponse(
+                in_thread(body) if asynchronous else body,
+                status=206, content_type=f'multipart/byteranges; boundary={boundary}',
+            )
+            response['Content-Length'] = str(multipart_length(ranges, stat.st_size, content_type, boundary))
+        response['Accept-Ranges'] = 'bytes'
+
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(stat.st_mtime)
+    response['Content-Disposition'] = content_disposition_header(True, filename)
+    return response
@@ -0,0 +1,99 @@
+import math
+import time
+
+from django.conf import settings
+
+from .redis_client import get_redis
+
+INFLIGHT_PREFIX = 'downloader:inflight:'
+LOCK_PREFIX = 'downloader:lock:'  # task id -> token of the worker run writing its files
+RUNS_PREFIX = 'downloader:runs:'  # task id -> runs started in a row that never finished
+
+# Only the task that owns a claim may clear it
+RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+# Only the run holding a lock (or the task owning a claim) may extend it
+REFRESH_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('expire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+_release = None
+_refresh = None
+
+def claim(key, task_id):
+    """Claim a media key for task_id, returning the id of the task that owns it"""
+    r = get_redis()
+    ttl = settings.VIDEO_DOWNLOADER['INFLIGHT_TTL']
+    while True:
+        if r.set(INFLIGHT_PREFIX + key, task_id, nx=True, ex=ttl):
+            return task_id
+        owner = r.get(INFLIGHT_PREFIX + key)
+        if owner:
+            return owner
+        # The previous owner finished between our SET and GET; try again
+
+def refresh(key, task_id, ahead=0):
+    """Keep task_id's claim for INFLIGHT_TTL more seconds after the next ahead seconds.
+
+    Deferrals, retries and hand-offs can keep a task busy for longer than one
+    INFLIGHT_TTL; a claim that lapsed meanwhile would let a duplicate request in.
+    """
+    ttl = settings.VIDEO_DOWNLOADER['INFLIGHT_TTL'] + math.ceil(ahead)
+    _scripts()[1](keys=[INFLIGHT_PREFIX + key], args=[task_id, ttl])
+
+def release(key, task_id):
+    """Clear the claim so the next request for this media starts a new task"""
+    _scripts()[0](keys=[INFLIGHT_PREFIX + key], args=[task_id])
+
+def lock_task(task_id, token):
+    """Take ownership of a task's output directory; False while another run holds it"""
+    ttl = settings.VIDEO_DOWNLOADER['TASK_LOCK_TTL']
+    return bool(get_redis().set(LOCK_PREFIX + task_id, token, nx=True, ex=ttl))
+
+def unlock_task(task_id, token):
+    """Give up ownership, unless the lock already expired and moved to another run"""
+    _scripts()[0](keys=[LOCK_PREFIX + task_id], args=[token])
+
+def begin_run(task_id):
+    """Count a run of the task; returns how many in a row started without finishing, this one included"""
+    pipe = get_redis().pipeline()
+    pipe.incr(RUNS_PREFIX + task_id)
+    pipe.expire(RUNS_PREFIX + task_id, 24 * 60 * 60)
+    return pipe.execute()[0]
+
+def end_run(task_id):
+    """The run finished without taking its worker process down"""
+    get_redis().delete(RUNS_PREFIX + task_id)
+
+def make_lock_hook(task_id, token, key):
+    """yt-dlp progress hook that keeps the task lock and the media key's claim alive
+    while bytes keep arriving.
+
+    A run that dies stops refreshing, so a retry can take over after TASK_LOCK_TTL.
+    """
+    ttl = settings.VIDEO_DOWNLOADER['TASK_LOCK_TTL']
+    last_refresh = [time.monotonic()]
+
+    def hook(d):
+        now = time.monotonic()
+        if now - last_refresh[0] >= ttl / 3:
+            last_refresh[0] = now
+            _scripts()[1](keys=[LOCK_PREFIX + task_id], args=[token, ttl])
+            refresh(key, task_id)
+    return hook
+
+def _scripts():
+    global _release, _refresh
+    if _release is None:
+        _release = get_redis().register_script(RELEASE_SCRIPT)
+    if _refresh is None:
+        _refresh = get_redis().register_script(REFRESH_SCRIPT)
+    return _release, _refresh
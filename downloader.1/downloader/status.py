@@ -0,0 +1,121 @@
+import json
+import time
+
+from celery import states
+from django.conf import settings
+
+from .progress import CHANNEL_PREFIX, SNAPSHOT_PREFIX
+from .redis_client import get_async_redis, get_redis
+from .tasks import download_video_task
+
+
+def compact_state(meta, snapshot):
+    """Short status for one task from its result-backend entry and latest progress event"""
+    if meta is None or meta['status'] in (states.PENDING, states.STARTED, states.RETRY):
+        if snapshot is None:
+            return {'state': 'pending'}
+        event = json.loads(snapshot)
+        state = {'state': event['state']}
+        if event.get('total_bytes') and event.get('downloaded_bytes') is not None:
+            state['progress'] = round(event['downloaded_bytes'] / event['total_bytes'], 3)
+        return state
+    if meta['status'] == states.SUCCESS:
+        result = meta['result']
+        if isinstance(result, dict) and result.get('status') == 'success':
+            return {'state': 'success'}
+        error = result.get('error') if isinstance(result, dict) else None
+        return {'state': 'error', 'error': error or 'Download failed or file not found'}
+    if meta['status'] == states.FAILURE:
+        return {'state': 'failed', 'error': str(meta['result'])}
+    return {'state': meta['status'].lower()}
+
+
+def read_states(task_ids):
+    """States for many tasks with one MGET on the result backend and one on progress snapshots"""
+    if not task_ids:
+        return {}
+    backend = download_video_task.backend
+    metas = backend.client.mget([backend.get_key_for_task(task_id) for task_id in task_ids])
+    snapshots = get_redis().mget([SNAPSHOT_PREFIX + task_id for task_id in task_ids])
+    return {
+        task_id: compact_state(backend.decode_result(meta) if meta else None, snapshot)
+        for task_id, meta, snapshot in zip(task_ids, metas, snapshots)
+    }
+
+
+async def aread_states(task_ids):
+    """read_states with the asyncio clients, for async views"""
+    backend = download_video_task.backend
+    metas = await get_async_redis(settings.CELERY_RESULT_BACKEND).mget(
+        [backend.get_key_for_task(task_id) for task_id in task_ids])
+    snapshots = await get_async_redis().mget([SNAPSHOT_PREFIX + task_id for task_id in task_ids])
+    return {
+        task_id: compact_state(backend.decode_result(meta) if meta else None, snapshot)
+        for task_id, meta, snapshot in zip(task_ids, metas, snapshots)
+    }
+
+
+def read_results(task_ids):
+    """Return values of the tasks among task_ids that have finished, with one MGET"""
+    if not task_ids:
+        return {}
+    backend = download_video_task.backend
+    metas = backend.client.mget([backend.get_key_for_task(task_id) for task_id in task_ids])
+    results = {}
+    for task_id, raw in zip(task_ids, metas):
+        meta = backend.decode_result(raw) if raw else None
+        if meta and meta['status'] == states.SUCCESS:
+            results[task_id] = meta['result']
+    return results
+
+
+async def read_meta(task_id):
+    """One task's result-backend entry (None while it has none), read with the asyncio client"""
+    backend = download_video_task.backend
+    raw = await get_async_redis(settings.CELERY_RESULT_BACKEND).get(backend.get_key_for_task(task_id))
+    return backend.decode_result(raw) if raw else None
+
+
+def changed(current, known):
+    return any(known.get(task_id) != state['state'] for task_id, state in current.items())
+
+
+async def wait_for_change(task_ids, known, timeout):
+    """Long-poll: return current states as soon as any differs from `known`, or after timeout.
+
+    Wakes on the tasks' progress channels (which also carry the final event), and
+    re-reads the backend every PROGRESS_KEEPALIVE seconds for changes that don't publish.
+    Waits on the asyncio client, so a long poll holds no thread.
+    """
+    if timeout <= 0:
+        return await aread_states(task_ids)
+
+    deadline = time.monotonic() + timeout
+    keepalive = settings.VIDEO_DOWNLOADER['PROGRESS_KEEPALIVE']
+    pubsub = get_async_redis().pubsub(ignore_subscribe_messages=True)
+    # Subscribe before the first read so no change can slip in between
+    await pubsub.subscribe(*[CHANNEL_PREFIX + task_id for task_id in task_ids])
+    try:
+        current = await aread_states(task_ids)
+        last_read = time.monotonic()
+        if changed(current, known):
+            return current
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return current
+            message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=min(remaining, keepalive))
+            if message:
+                # Progress ticks that don't change a task's state need no re-read
+                task_id = message['channel'][len(CHANNEL_PREFIX):]
+                if json.loads(message['data'])['state'] == known.get(task_id):
+                    continue
+            elif time.monotonic() - last_read < keepalive:
+                continue
+            current = await aread_states(task_ids)
+            last_read = time.monotonic()
+            if changed(current, known):
+                return current
+    finally:
+        await pubsub.unsubscribe()
+        await pubsub.aclose()
@@ -0,0 +1,153 @@
+"""Where finished downloads are kept and how download_file hands them out.
+
+Workers always write into downloads/ and then pass the finished file to the
+configured backend. Results, cache entries, history rows and the quota index all
+refer to a file by that downloads/ path; each backend maps it to its own location.
+"""
+import mimetypes
+import os
+from contextlib import contextmanager
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.http import HttpResponseRedirect
+from django.utils.http import content_disposition_header
+from django.utils.module_loading import import_string
+
+from .quota import FILES_KEY, downloads_dir, prune_empty_dirs
+from .redis_client import get_async_redis, get_redis
+from .serving import serve_file
+
+@lru_cache(maxsize=None)
+def get_storage():
+    """The backend named by VIDEO_DOWNLOADER['STORAGE_BACKEND'], one per process"""
+    return import_string(settings.VIDEO_DOWNLOADER['STORAGE_BACKEND'])()
+
+
+class LocalStorage:
+    """Files stay in downloads/, so web nodes must share that disk with the workers"""
+    remote = False
+
+    def save(self, file_path):
+        """Take over a finished file; it is already where it is served from"""
+
+    def delete(self, file_path):
+        os.remove(file_path)
+        prune_empty_dirs(file_path)
+
+    def exists(self, file_path):
+        return os.path.exists(file_path)
+
+    async def aexists(self, file_path):
+        return os.path.exists(file_path)
+
+    def open(self, file_path):
+        return open(file_path, 'rb')
+
+    @contextmanager
+    def local_copy(self, file_path):
+        """The file on this node's disk, e.g. as an ffmpeg input"""
+        yield file_path
+
+    def response(self, request, file_path, filename):
+        return serve_file(request, file_path, filename)
+
+
+class S3Storage:
+    """Files are uploaded to an S3-compatible bucket (AWS, MinIO, ...) and clients are
+    redirected to presigned URLs, so web nodes never see the bytes.
+
+    An uploaded file is in the quota index until it is deleted, so existence checks
+    read the index instead of sending a HEAD request per status poll.
+    """
+    remote = True
+
+    def __init__(self):
+        try:
+            import boto3
+            from boto3.s3.transfer import TransferConfig
+            from botocore.config import Config
+            from botocore.exceptions import BotoCoreError, ClientError
+        except ImportError as e:
+            raise ImproperlyConfigured('S3Storage requires boto3') from e
+
+        config = settings.VIDEO_DOWNLOADER['S3']
+        self.bucket = config['BUCKET']
+        self.prefix = config['KEY_PREFIX']
+        self.url_expiry = config['URL_EXPIRY']
+        self.errors = (BotoCoreError, ClientError)
+
+        def client(endpoint_url):
+            return boto3.client(
+                's3',
+                endpoint_url=endpoint_url,
+                region_name=config['REGION'],
+                aws_access_key_id=config['ACCESS_KEY_ID'],
+                aws_secret_access_key=config['SECRET_ACCESS_KEY'],
+                config=Config(signature_version='s3v4', s3={'addressing_style': config['ADDRESSING_STYLE']}),
+            )
+        self.client = client(config['ENDPOINT_URL'])
+        # Presigned URLs are signed for the host clients connect to
+        self.signer = client(config['PUBLIC_ENDPOINT_URL']) if config['PUBLIC_ENDPOINT_URL'] else self.client
+        # Files over one part are sent as a multipart upload, several parts at a time,
+        # each read from disk as it goes out
+        self.transfer = TransferConfig(
+            multipart_threshold=config['MULTIPART_PART_SIZE'],
+            multipart_chunksize=config['MULTIPART_PART_SIZE'],
+            max_concurrency=config['UPLOAD_CONCURRENCY'],
+        )
+
+    def key(self, file_path):
+        """Object key: the path under downloads/, e.g. '<shard>/<task id>/<name>'"""
+        return self.prefix + os.path.relpath(file_path, downloads_dir()).replace(os.sep, '/')
+
+    def save(self, file_path):
+        """Upload a finished file, then remove the worker's copy"""
+        content_type = mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
+        self.client.upload_file(
+            file_path, self.bucket, self.key(file_path),
+            ExtraArgs={'ContentType': content_type}, Config=self.transfer,
+        )
+        os.remove(file_path)
+        prune_empty_dirs(file_path)
+
+    def delete(self, file_path):
+        try:
+            self.client.delete_object(Bucket=self.bucket, Key=self.key(file_path))
+        except self.errors as e:
+            raise OSError(f'Could not delete {self.key(file_path)} from {self.bucket}: {e}') from e
+
+    def exists(self, file_path):
+        return get_redis().hexists(FILES_KEY, file_path)
+
+    async def aexists(self, file_path):
+        return await get_async_redis().hexists(FILES_KEY, file_path)
+
+    def open(self, file_path):
+        """A readable stream of the object, for the rare responses built from file contents"""
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=self.key(file_path))['Body']
+        except self.errors as e:
+            raise OSError(f'Could not read {self.key(file_path)} from {self.bucket}: {e}') from e
+
+    @contextmanager
+    def local_copy(self, file_path):
+        """The file downloaded back to its downloads/ path for the duration of the block"""
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        try:
+            self.client.download_file(self.bucket, self.key(file_path), file_path, Config=self.transfer)
+            yield file_path
+        finally:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+    def response(self, request, file_path, filename):
+        """Redirect to a presigned GET, which the store serves with Range support"""
+        url = self.signer.generate_presigned_url('get_object', Params={
+            'Bucket': self.bucket,
+            'Key': self.key(file_path),
+            'ResponseContentDisposition': content_disposition_header(True, filename),
+            'ResponseContentType': mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+        }, ExpiresIn=self.url_expiry)
+        return HttpResponseRedirect(url)
@@ -1,171 +1,336 @@
-from celery import shared_task
+from celery import group, shared_task, states
+from celery.exceptions import Ignore, SoftTimeLimitExceeded
+from celery.signals import before_task_publish, task_postrun, task_prerun, worker_process_init, worker_process_shutdown
+from celery.utils import uuid
 import yt_dlp
+from yt_dlp.networking.exceptions import HTTPError, TransportError
 import os
-import glob
+import shutil
 import time
 import random
 
 from django.conf import settings
+from django.utils import timezone
 
-# Global rate limiting
-last_download_time = {}
-download_count = {}
+from . import admission, audio, cache, history, limiter, metadata, metrics, pool, progress, quota, singleflight, tuning, watchdog
+from .keys import extra_extractor, may_be_playlist, media_key, request_key
+from .models import Download
+from .routing import route_for
+from .storage import get_storage
+
+class Interrupted(Exception):
+    """A download stopped for a reason worth retrying; its partial files are kept"""
+
+# Network hiccups and server errors are retried; anything else fails the task right away
+TRANSIENT_MESSAGES = (
+    'timed out', 'connection reset', 'connection aborted', 'remote end closed', 'incompleteread',
+    'content too short', 'temporary failure in name resolution', 'giving up after',
+)
+
+def is_transient(error):
+    exc = error.exc_info[1] if getattr(error, 'exc_info', None) else None
+    if isinstance(exc, HTTPError):
+        return exc.status >= 500
+    if isinstance(exc, (TransportError, yt_dlp.utils.ContentTooShortError)):
+        return True
+    message = str(error).lower()
+    if 'http error 5' in message:
+        return True
+    return any(text in message for text in TRANSIENT_MESSAGES)
+
+# Enhanced user agents rotation
+USER_AGENTS = [
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0) Gecko/20100101 Firefox/121.0',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:109.0) Gecko/20100101 Firefox/121.0'
+]
+
+def base_options(download_type):
+    """yt-dlp options a pooled context is built with, per media type"""
+    formats = settings.VIDEO_DOWNLOADER['FORMATS']
+    if download_type == 'audio':
+        return {
+            'format': formats['audio'],
+            'quiet': False,
+            'noplaylist': True,
+            'geo_bypass': True,
+            'socket_timeout': settings.VIDEO_DOWNLOADER['STALL_WINDOW'],  # a silent connection counts as stalled
+            'fragment_retries': 5,  # More retries
+            'retries': 5,
+            'retry_sleep': 2,  # Sleep between retries
+            'continuedl': True,  # Resume .part files left by an interrupted attempt
+        }
+    # video download
+    return {
+        'format': formats['video'],
+        'quiet': False,
+        'noplaylist': True,
+        'geo_bypass': True,
+        'merge_output_format': 'mp4',
+        'socket_timeout': settings.VIDEO_DOWNLOADER['STALL_WINDOW'],  # a silent connection counts as stalled
+        'fragment_retries': 5,  # More retries
+        'retries': 5,
+        'retry_sleep': 2,  # Sleep between retries
+        'continuedl': True,  # Resume .part files left by an interrupted attempt
+        'extractor_args': {
+            'tiktok': {
+                'webpage_url_extractor': True
+            },
+            'twitter': {
+                'api': 'syndication'  # Use syndication API for Twitter
+            }
+        }
+    }
+
+@shared_task(
+    bind=True,
+    autoretry_for=(Interrupted,),
+    max_retries=settings.VIDEO_DOWNLOADER['RETRY_MAX'],
+    retry_backoff=settings.VIDEO_DOWNLOADER['RETRY_BACKOFF'],
+    retry_backoff_max=settings.VIDEO_DOWNLOADER['RETRY_BACKOFF_MAX'],
+    retry_jitter=True,
+    # A worker that dies mid-download leaves the message unacknowledged, so it is redelivered
+    acks_late=True,
+    reject_on_worker_lost=True,
+    # The soft limit lets the task clean up and report the failure; the hard one kills it
+    soft_time_limit=settings.VIDEO_DOWNLOADER['DOWNLOAD_TIMEOUT'],
+    time_limit=settings.VIDEO_DOWNLOADER['DOWNLOAD_TIMEOUT'] + settings.VIDEO_DOWNLOADER['TIME_LIMIT_GRACE'],
+)
+def download_video_task(self, url, download_type, not_before=None, audio_format=None, batch=False):
+    key = request_key(url, download_type, audio_format)
+    domain = extract_domain(url)
+    output_dir = quota.task_dir(self.request.id)
+    config = settings.VIDEO_DOWNLOADER
+    deferred = False
+    handed_off = False
+    retrying = False
+    lock_token = None
+
+    def defer(countdown, not_before=None):
+        """Send this task again under the same id instead of waiting in the worker slot"""
+        delivery_info = self.request.delivery_info or {}
+        self.apply_async(
+            (url, download_type), {'not_before': not_before, 'audio_format': audio_format, 'batch': batch},
+            task_id=self.request.id, countdown=countdown, retries=self.request.retries,
+            priority=delivery_info.get('priority'),
+        )
+        singleflight.refresh(key, self.request.id, countdown)
+        if delivery_info.get('routing_key'):
+            admission.deferred(delivery_info['routing_key'], delivery_info.get('priority'), self.request.id, countdown)
 
-@shared_task
-def download_video_task(url, download_type):
     try:
         print(f"Received in Celery: URL={url}, Type={download_type}")
+        # acks_late redelivers the message of a run that killed its worker; stop doing so eventually
+        losses = singleflight.begin_run(self.request.id) - 1
+        if losses >= config['MAX_WORKER_LOSSES']:
+            print(f"Giving up on {url}: {losses} runs in a row took the worker process down")
+            metrics.inc('downloader_aborted_total', reason='worker_lost', domain=domain)
+            discard_output(output_dir)
+            return {'status': 'error', 'error': f'Download failed: the worker was lost {losses} times'}
+        sent_at = self.request.get('sent_at')
+        if sent_at:
+            # A deferred task only starts waiting in the queue once its booked slot arrives
+            metrics.observe('downloader_stage_seconds', time.time() - max(sent_at, not_before or 0), stage='queue_wait')
+
+        # Another task may have fetched the same media while this one was queued
+        with metrics.span('cache_lookup'):
+            cached = cache.lookup(key)
+        if cached:
+            print(f"Cache hit for {url}")
+            return dict(cached, cached=True)
+
+        # The video may have been downloaded since this audio request was queued
+        if download_type == 'audio':
+            source = cache.lookup(media_key(url, 'video'))
+            if source:
+                hand_off_audio(self.request.id, url, audio_format, source)
+                handed_off = True
+                raise Ignore()
         
-        # Rate limiting: Wait between downloads from same domain
-        domain = extract_domain(url)
-        current_time = time.time()
-        
-        if domain in last_download_time:
-            time_since_last = current_time - last_download_time[domain]
-            if time_since_last < 10:  # Wait at least 10 seconds between downloads from same domain
-                wait_time = 10 - time_since_last + random.uniform(1, 3)  # Add random delay
-                print(f"Rate limiting: waiting {wait_time:.1f} seconds for {domain}")
-                time.sleep(wait_time)
-        
-        # Track download count per domain
-        if domain not in download_count:
-            download_count[domain] = 0
-        download_count[domain] += 1
-        last_download_time[domain] = time.time()
-        
-        # Reset count every hour (simple reset)
-        if download_count[domain] > 20:  # Reset after 20 downloads
-            print(f"Resetting download count for {domain}")
-            download_count[domain] = 0
-            time.sleep(random.uniform(5, 15))  # Longer wait after reset
-        
-        # Create downloads directory if it doesn't exist
-        downloads_dir = os.path.join(settings.BASE_DIR, 'downloads')
-        os.makedirs(downloads_dir, exist_ok=True)
+        # Batch items take the domain's token and lease as they start rather than when the
+        # batch is expanded, so a large batch queues behind the limiter instead of bypassing it
+        if batch and not_before is None:
+            allowed, reason, retry_after = limiter.admit(domain, self.request.id)
+            if not allowed:
+                wait_time = min(retry_after, config['BATCH_ADMIT_INTERVAL'])
+                print(f"Rate limiting ({reason}): batch download from {domain} waits {wait_time:.1f} seconds")
+                metrics.inc('downloader_rate_limited_total', reason=reason, domain=domain)
+                defer(wait_time)
+                deferred = True
+                raise Ignore()
+
+        # Rate limiting: spacing between downloads from the same domain is shared cluster-wide.
+        # Instead of sleeping in the worker slot, re-enqueue this task for its booked start time
+        # and free the slot for other domains. Slots are only booked a little way ahead, so a
+        # backlog can't claim the domain for hours and interactive requests still get in.
+        if not_before is None:
+            booked, wait_time = limiter.reserve_slot(
+                domain, config['BATCH_MAX_SLOT_AHEAD'] if batch else config['MAX_SLOT_AHEAD'])
+            if not booked:
+                print(f"Rate limiting: {domain} is booked up; asking again in {wait_time:.1f} seconds")
+                metrics.inc('downloader_deferrals_total', domain=domain)
+                defer(wait_time)
+                deferred = True
+                raise Ignore()
+            not_before = time.time() + wait_time
+        wait_time = not_before - time.time()
+        if wait_time > 0:
+            print(f"Rate limiting: deferring {domain} download by {wait_time:.1f} seconds")
+            metrics.inc('downloader_deferrals_total', domain=domain)
+            metrics.observe('downloader_stage_seconds', wait_time, stage='throttle')
+            defer(wait_time, not_before)
+            deferred = True
+            raise Ignore()
+
+        # Only one run may write into the task's directory. Another one holding the lock
+        # (e.g. a redelivered message while the first worker is still going) waits its turn.
+        lock_token = uuid()
+        if not singleflight.lock_task(self.request.id, lock_token):
+            lock_token = None
+            print(f"Task {self.request.id} is being downloaded by another worker; checking back later")
+            defer(config['TASK_LOCK_TTL'], not_before)
+            deferred = True
+            raise Ignore()
+        if self.request.retries:
+            print(f"Resuming {url} (attempt {self.request.retries + 1})")
+
+        # Fragment parallelism and chunk size follow this domain's recent throughput
+        params = tuning.choose(domain)
+        samples = []
+        history.update(
+            self.request.id, state=Download.RUNNING, started=timezone.now(),
+            fragments=params['fragments'], chunk_size=params['chunk_size'],
+        )
         
-        # Enhanced user agents rotation
-        user_agents = [
-            'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-            'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-            'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.0.0 Safari/537.36',
-            'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-            'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0) Gecko/20100101 Firefox/121.0',
-            'Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:109.0) Gecko/20100101 Firefox/121.0'
-        ]
+        # Each task writes into its own directory, so names never collide between tasks
+        os.makedirs(output_dir, exist_ok=True)
+        final_paths = []
+        marks = {}
         
-        selected_ua = random.choice(user_agents)
+        selected_ua = random.choice(USER_AGENTS)
         
-        # Configure options based on download type
-        if download_type == 'audio':
-            ydl_opts = {
-                'format': 'bestaudio[ext=m4a]/bestaudio/best',
-                'outtmpl': os.path.join(downloads_dir, '%(title)s.%(ext)s'),
-                'quiet': False,
-                'noplaylist': True,
-                'geo_bypass': True,
-                'socket_timeout': 45,  # Increased timeout
-                'fragment_retries': 5,  # More retries
-                'retries': 5,
-                'retry_sleep': 2,  # Sleep between retries
-                'user_agent': selected_ua,
-                'referer': get_referer(url),
-                'sleep_interval': random.uniform(1, 3),  # Random sleep between fragments
-                'max_sleep_interval': 5,
-                'headers': get_headers(selected_ua),
-                'http_chunk_size': 1048576,  # 1MB chunks to be less aggressive
-            }
-        else:  # video download
-            ydl_opts = {
-                'format': 'best[height<=720]/best',
-                'outtmpl': os.path.join(downloads_dir, '%(title)s.%(ext)s'),
-                'quiet': False,
-                'noplaylist': True,
-                'geo_bypass': True,
-                'merge_output_format': 'mp4',
-                'socket_timeout': 45,  # Increased timeout
-                'fragment_retries': 5,  # More retries
-                'retries': 5,
-                'retry_sleep': 2,  # Sleep between retries
-                'user_agent': selected_ua,
-                'referer': get_referer(url),
-                'sleep_interval': random.uniform(1, 3),  # Random sleep between fragments
-                'max_sleep_interval': 5,
-                'headers': get_headers(selected_ua),
-                'http_chunk_size': 1048576,  # 1MB chunks to be less aggressive
-                'extractor_args': {
-                    'tiktok': {
-                        'webpage_url_extractor': True
-                    },
-                    'twitter': {
-                        'api': 'syndication'  # Use syndication API for Twitter
-                    }
-                }
-            }
+        # Per-task options; the ones that only matter when a YoutubeDL is built come from
+        # base_options and are shared by the pooled context
+        ydl_opts = {
+            'outtmpl': os.path.join(output_dir, '%(id)s.%(ext)s'),
+            'user_agent': selected_ua,
+            'referer': get_referer(url),
+            'headers': get_headers(selected_ua),
+            'progress_hooks': [
+                progress.make_progress_hook(self.request.id),
+                tuning.make_meter_hook(samples),
+                metrics.make_stage_hook(marks),
+                singleflight.make_lock_hook(self.request.id, lock_token, key),
+                watchdog.make_stall_hook(),
+            ],
+            'post_hooks': [final_paths.append],  # Called with the path after all postprocessing
+        }
+
+        # Spacing between downloads is handled by the limiter above, so no sleep_interval here
+        ydl_opts.update(tuning.ydl_options(params))
+        extra = extra_extractor(url)
+        # A preview may have extracted the page already; its format URLs are still fresh
+        cached_info = metadata.lookup(url)
+        run_started = time.perf_counter()
+        info = None
+        if cached_info and cached_info['_type'] == 'video':
+            try:
+                with pool.borrow(domain, download_type, base_options(download_type), ydl_opts) as (ydl, context):
+                    info = ydl.process_ie_result(cached_info, download=True)
+            except yt_dlp.utils.DownloadError as e:
+                # Format URLs expire and may be bound to the IP that extracted them
+                # (e.g. googlevideo), so a failed replay gets one fresh extraction, on a
+                # fresh context since borrow() closed the failed one.
+                # Interruptions are resumed by the retry below instead.
+                if is_transient(e):
+                    raise
+                print(f"Cached info for {url} failed ({e}); extracting it again")
+                metadata.forget(url)
+        if info is None:
+            with pool.borrow(domain, download_type, base_options(download_type), ydl_opts) as (ydl, context):
+                info = ydl.extract_info(url, download=True, ie_key=extra.ie_key() if extra else None)
+        metrics.observe_run(marks, run_started, time.perf_counter(), context=context)
+        metrics.observe_throughput(domain, *tuning.totals(samples))
+        throughput = tuning.record(domain, params, samples)
+        if throughput:
+            # Fragment parallelism only applies to HLS/DASH downloads
+            fragments = params['fragments'] if tuning.fragmented(samples) else None
+            history.update(self.request.id, throughput=throughput, fragments=fragments)
+
+        # yt-dlp reports exactly where the finished file ended up
+        file_path = final_paths[-1] if final_paths else None
 
-        # Add random delay before starting download
-        initial_delay = random.uniform(0.5, 2.0)
-        time.sleep(initial_delay)
-
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
-            file_path = ydl.prepare_filename(info)
-            
-            # For audio downloads, check for mp3 file
-            if download_type == 'audio':
-                base_path = os.path.splitext(file_path)[0]
-                mp3_path = base_path + '.mp3'
-                if os.path.exists(mp3_path):
-                    file_path = mp3_path
-
-            # Check if file exists and is not empty
-            if os.path.exists(file_path) and os.path.getsize(file_path) > 0:
-                return {
-                    'status': 'success',
+        # Check if file exists and is not empty
+        if file_path and os.path.exists(file_path) and os.path.getsize(file_path) > 0:
+            size = os.path.getsize(file_path)
+            if download_type == 'audio' and not file_path.endswith('.' + audio.default_format(audio_format)):
+                # The site had no audio-only stream in this format; convert it off the download queue,
+                # which may run on another node
+                get_storage().save(file_path)
+                hand_off_audio(self.request.id, url, audio_format, {
                     'file_path': file_path,
-                    'title': info.get("title"),
+                    'title': info.get('title'),
                     'thumbnail': info.get('thumbnail'),
                     'duration': info.get('duration'),
                     'uploader': info.get('uploader'),
-                }
-            else:
-                # Try to find any downloaded file in the directory (excluding .part files)
-                video_id = info.get('id', '')
-                title_words = info.get('title', '').replace(' ', '_').split('_')[:3]
-                
-                for filename in os.listdir(downloads_dir):
-                    # Skip partial files
-                    if filename.endswith('.part'):
-                        continue
-                        
-                    file_path_candidate = os.path.join(downloads_dir, filename)
-                    
-                    # Check if this file matches our download
-                    if (video_id and video_id in filename) or \
-                       any(word in filename for word in title_words if len(word) > 2):
-                        if os.path.getsize(file_path_candidate) > 0:
-                            return {
-                                'status': 'success',
-                                'file_path': file_path_candidate,
-                                'title': info.get("title"),
-                                'thumbnail': info.get('thumbnail'),
-                                'duration': info.get('duration'),
-                                'uploader': info.get('uploader'),
-                            }
-                
-                # Clean up any partial files for this download
-                title_clean = info.get('title', '').replace(' ', '_')
-                part_pattern = os.path.join(downloads_dir, f"*{title_clean}*.part")
-                for part_file in glob.glob(part_pattern):
-                    try:
-                        os.remove(part_file)
-                        print(f"Cleaned up partial file: {part_file}")
-                    except:
-                        pass
-                
-                return {'status': 'error', 'error': 'Download failed or file was not created properly'}
+                }, keep_source=False)
+                handed_off = True
+                raise Ignore()
+            result = {
+                'status': 'success',
+                'file_path': file_path,
+                'filename': download_filename(info, file_path),
+                'title': info.get("title"),
+                'thumbnail': info.get('thumbnail'),
+                'duration': info.get('duration'),
+                'uploader': info.get('uploader'),
+                'size': size,
+            }
+            with metrics.span('store'):
+                get_storage().save(file_path)
+                quota.register(file_path, self.request.id, size=size)
+                cache.store(key, result)
+                quota.enforce()
+            return result
+
+        discard_output(output_dir)
+        return {'status': 'error', 'error': 'Download failed or file was not created properly'}
 
+    except Ignore:
+        raise
+    except watchdog.Stalled as e:
+        metrics.inc('downloader_aborted_total', reason='stalled', domain=domain)
+        if self.request.retries < self.max_retries:
+            # The .part files stay, so the next attempt resumes where this one stalled
+            print(f"Download stalled, will resume: {e}")
+            progress.publish(self.request.id, {'state': 'retrying', 'attempt': self.request.retries + 1, 'error': str(e)})
+            retrying = True
+            singleflight.refresh(key, self.request.id, config['RETRY_BACKOFF_MAX'])
+            raise Interrupted(str(e)) from e
+        print(f"Download stalled: {e}")
+        discard_output(output_dir)
+        return {'status': 'error', 'error': f'Download stalled: {e}'}
+    except SoftTimeLimitExceeded:
+        timeout = settings.VIDEO_DOWNLOADER['DOWNLOAD_TIMEOUT']
+        print(f"Download of {url} hit the {timeout}s time limit")
+        metrics.inc('downloader_aborted_total', reason='time_limit', domain=domain)
+        discard_output(output_dir)
+        return {'status': 'error', 'error': f'Download took longer than {timeout} seconds'}
     except yt_dlp.utils.DownloadError as e:
         error_msg = str(e)
+        # The next attempt extracts the page again in case the cached format URLs went stale
+        metadata.forget(url)
+        if is_transient(e) and self.request.retries < self.max_retries:
+            # yt-dlp continues the .part file and skips finished fragments on the next attempt
+            print(f"Download interrupted, will resume: {error_msg}")
+            progress.publish(self.request.id, {'state': 'retrying', 'attempt': self.request.retries + 1, 'error': error_msg})
+            retrying = True
+            singleflight.refresh(key, self.request.id, config['RETRY_BACKOFF_MAX'])
+            raise Interrupted(error_msg) from e
+        discard_output(output_dir)
         if 'HTTP Error 429' in error_msg or 'rate limit' in error_msg.lower():
             return {'status': 'error', 'error': 'Rate limited. Please wait a few minutes before trying again.'}
         elif 'HTTP Error 403' in error_msg or 'blocked' in error_msg.lower():
@@ -174,7 +339,205 @@ def download_video_task(url, download_type):
             return {'status': 'error', 'error': f'Download error: {error_msg}'}
     except Exception as e:
         print(f"Error in download_video_task: {str(e)}")
+        discard_output(output_dir)
         return {'status': 'error', 'error': str(e)}
+    finally:
+        if lock_token:
+            singleflight.unlock_task(self.request.id, lock_token)
+        # Let later requests for this media start fresh (or hit the cache)
+        if not deferred and not handed_off and not retrying:
+            singleflight.release(key, self.request.id)
+
+def hand_off_audio(task_id, url, audio_format, source, keep_source=True):
+    """Continue a task as an audio extraction on the transcode queue, under the same id"""
+    print(f"Extracting audio for {url} from {source['file_path']}")
+    singleflight.refresh(request_key(url, 'audio', audio_format), task_id)
+    extract_audio_task.apply_async((url, audio_format, source), {'keep_source': keep_source}, task_id=task_id)
+
+@shared_task(bind=True)
+def extract_audio_task(self, url, audio_format, source, keep_source=True):
+    """Extract or remux the audio of a downloaded file; runs on the transcode queue"""
+    audio_format = audio.default_format(audio_format)
+    key = request_key(url, 'audio', audio_format)
+    try:
+        history.update(self.request.id, state=Download.RUNNING, started=timezone.now())
+        progress.publish(self.request.id, {'state': 'processing'})
+        storage = get_storage()
+        try:
+            with metrics.span('transcode', format=audio_format), storage.local_copy(source['file_path']) as source_path:
+                file_path = audio.extract(source_path, audio_format)
+        finally:
+            if not keep_source:
+                storage.delete(source['file_path'])
+
+        title = yt_dlp.utils.sanitize_filename(source.get('title') or os.path.basename(file_path))
+        result = {
+            'status': 'success',
+            'file_path': file_path,
+            'filename': f'{title}.{audio_format}',
+            'title': source.get('title'),
+            'thumbnail': source.get('thumbnail'),
+            'duration': source.get('duration'),
+            'uploader': source.get('uploader'),
+            'size': os.path.getsize(file_path),
+        }
+        storage.save(file_path)
+        quota.register(file_path, self.request.id, size=result['size'])
+        cache.store(key, result)
+        quota.enforce()
+        return result
+    except Exception as e:
+        print(f"Error in extract_audio_task: {str(e)}")
+        if not keep_source:
+            discard_output(os.path.dirname(source['file_path']))
+        return {'status': 'error', 'error': f'Audio extraction failed: {e}'}
+    finally:
+        singleflight.release(key, self.request.id)
+
+@shared_task
+def expand_batch_task(urls, media_type, audio_format=None):
+    """Expand playlists in a batch and fan the downloads out as one group"""
+    from .dispatch import prepare
+
+    limit = settings.VIDEO_DOWNLOADER['MAX_BATCH_SIZE']
+    items = []
+    for url in urls:
+        if not may_be_playlist(url):
+            items.append({'url': url})
+            continue
+        # One flat metadata pass lists the entries without extracting each video
+        try:
+            extra = extra_extractor(url)
+            with pool.build({'extract_flat': 'in_playlist', 'quiet': True}) as ydl:
+                info = ydl.extract_info(url, download=False, ie_key=extra.ie_key() if extra else None)
+        except Exception as e:
+            items.append({'url': url, 'status': 'failed', 'error': str(e)})
+            continue
+        if info.get('_type') == 'playlist':
+            for entry in info.get('entries') or []:
+                if entry and (entry.get('webpage_url') or entry.get('url')):
+                    items.append({'url': entry.get('webpage_url') or entry['url'], 'playlist': url})
+        else:
+            items.append({'url': url})
+
+    # Playlists can list more than a batch may hold; the result says how many were left out
+    dropped = max(len(items) - limit, 0)
+    items = items[:limit]
+
+    # The domain's limits and spacing are applied by each download task as it starts
+    penalty = settings.VIDEO_DOWNLOADER['BATCH_PRIORITY_PENALTY']
+    signatures = []
+    rows = []
+    for item in items:
+        if 'status' in item:
+            continue
+        task_id, how, signature, row, _ = prepare(item['url'], media_type, admit=False, audio_format=audio_format)
+        item['task_id'] = task_id
+        if signature:
+            _, priority = route_for(item['url'], media_type)
+            signatures.append(signature.set(priority=min(9, priority + penalty)))
+        if row:
+            rows.append(row)
+    Download.objects.bulk_create(rows, ignore_conflicts=True)
+    if signatures:
+        group(signatures).apply_async()
+
+    result = {'status': 'success', 'media_type': media_type, 'items': items}
+    if dropped:
+        result.update(truncated=True, dropped=dropped)
+    return result
+
+@shared_task
+def maintain_storage_task():
+    """Periodic cleanup of downloads/, run by celery beat off the request path"""
+    cache.evict()
+    stats = quota.maintain()
+    print(f"Storage maintenance: {stats}")
+    return stats
+
+@task_postrun.connect(sender=download_video_task)
+@task_postrun.connect(sender=extract_audio_task)
+def publish_final_state(task_id=None, retval=None, state=None, **kwargs):
+    """Tell progress subscribers the task is done (deferred runs are not)"""
+    if state in (states.SUCCESS, states.FAILURE):
+        progress.publish_result(task_id, retval)
+        history.finished(task_id, retval)
+        if state == states.FAILURE:
+            outcome = 'failed'
+        else:
+            outcome = 'success' if isinstance(retval, dict) and retval.get('status') == 'success' else 'error'
+        metrics.inc('downloader_downloads_total', outcome=outcome)
+        metrics.flush()
+
+@task_postrun.connect(sender=download_video_task)
+def mark_run_finished(task_id=None, **kwargs):
+    """The run ended in the worker (whatever its state), so it doesn't count as a lost one"""
+    singleflight.end_run(task_id)
+
+@task_postrun.connect(sender=download_video_task)
+@task_postrun.connect(sender=extract_audio_task)
+def flush_task_history(task_id=None, **kwargs):
+    """Write this run's updates before the next run, maybe on another worker, takes over the row"""
+    history.flush([task_id])
+
+@task_prerun.connect(sender=download_video_task)
+def hold_lease(task_id=None, args=None, kwargs=None, **extra):
+    """Count the download as active for the whole of this run, however long it queued.
+
+    A batch item gets its lease when the limiter admits it, so until then there is none to extend.
+    """
+    limiter.hold(extract_domain(args[0]), task_id, extend_only=bool((kwargs or {}).get('batch')))
+
+@task_postrun.connect(sender=download_video_task)
+@task_postrun.connect(sender=extract_audio_task)
+def release_lease(task_id=None, args=None, state=None, **kwargs):
+    """Deferred, retried and handed-off runs keep the lease; the final one gives it back"""
+    if state in (states.SUCCESS, states.FAILURE):
+        limiter.release(extract_domain(args[0]), task_id)
+
+@task_prerun.connect(sender=download_video_task)
+def clear_deferral(task_id=None, task=None, **kwargs):
+    """A deferred run that starts no longer counts as waiting for admission control"""
+    queue = (task.request.delivery_info or {}).get('routing_key')
+    if queue:
+        admission.started(queue, task_id)
+
+@task_postrun.connect(sender=download_video_task)
+def record_completion(task_id=None, task=None, state=None, **kwargs):
+    """Feed admission control's drain rate with runs that did the work, not deferrals"""
+    queue = (task.request.delivery_info or {}).get('routing_key')
+    if queue and state in (states.SUCCESS, states.FAILURE, states.RETRY):
+        admission.record_completion(queue, task_id)
+
+@before_task_publish.connect(sender=download_video_task.name)
+def stamp_sent_at(headers=None, **kwargs):
+    """Send time, so the worker can measure how long the task waited in the queue"""
+    headers['sent_at'] = time.time()
+
+@worker_process_init.connect
+def warm_pool(**kwargs):
+    pool.warm(base_options)
+
+@worker_process_shutdown.connect
+def close_pool(**kwargs):
+    pool.close_all()
+
+@worker_process_shutdown.connect
+def flush_history(**kwargs):
+    history.flush()
+    metrics.flush()
+
+def discard_output(output_dir):
+    """Remove a failed task's directory along with its partial files"""
+    if os.path.isdir(output_dir):
+        shutil.rmtree(output_dir, ignore_errors=True)
+        print(f"Cleaned up partial output: {output_dir}")
+
+def download_filename(info, file_path):
+    """Readable name for the attachment; files on disk are named by video id"""
+    ext = os.path.splitext(file_path)[1]
+    title = yt_dlp.utils.sanitize_filename(info.get('title') or info.get('id') or 'download')
+    return title + ext
 
 def extract_domain(url):
     """Extract domain from URL for rate limiting"""
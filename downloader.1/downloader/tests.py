@@ -1,3 +1,582 @@
-from django.test import TestCase
+import io
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import zipfile
+from unittest import mock
 
-# Create your tests here.
+import redis
+from celery.utils import uuid
+from django.conf import settings
+from django.test import TestCase, TransactionTestCase, override_settings
+
+from . import admission, history, limiter, metadata, quota, redis_client, singleflight, tuning, watchdog
+from .archive import iter_zip, unique_name
+from .keys import media_key, request_key
+from .bench import start_server
+from .dispatch import RateLimited
+from .models import Download
+from .redis_client import get_redis
+from .serving import iter_multipart, multipart_length, parse_ranges
+from .tasks import download_video_task, extract_domain
+
+
+class RedisTestCase(TransactionTestCase):
+    """Runs against a scratch database (15) of the configured Redis, emptied before each test.
+
+    Async views save rows from another thread, which SQLite's shared test database
+    only allows outside of TestCase's open transaction.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.redis_url = redis_client.redis_url().rsplit('/', 1)[0] + '/15'
+        try:
+            redis.Redis.from_url(cls.redis_url).ping()
+        except redis.ConnectionError:
+            raise unittest.SkipTest('Redis is not available')
+        super().setUpClass()
+
+    def setUp(self):
+        client = redis.Redis.from_url(self.redis_url, decode_responses=True)
+        client.flushdb()
+        self.addCleanup(client.close)
+        self.enterContext(override_settings(VIDEO_DOWNLOADER=dict(settings.VIDEO_DOWNLOADER, REDIS_URL=self.redis_url)))
+        self.enterContext(mock.patch.object(redis_client, '_client', client))
+        # Scripts stay bound to the client they were registered with
+        self.enterContext(mock.patch.dict(limiter._scripts, clear=True))
+        self.enterContext(mock.patch.multiple(singleflight, _release=None, _refresh=None))
+
+    def config(self, **overrides):
+        """Override VIDEO_DOWNLOADER entries for the rest of the test"""
+        self.enterContext(override_settings(VIDEO_DOWNLOADER=dict(settings.VIDEO_DOWNLOADER, **overrides)))
+
+
+class ParseRangesTests(TestCase):
+    def test_single_ranges(self):
+        self.assertEqual(parse_ranges('bytes=0-99', 1000), [(0, 99)])
+        self.assertEqual(parse_ranges('bytes=900-', 1000), [(900, 999)])
+        self.assertEqual(parse_ranges('bytes=-100', 1000), [(900, 999)])
+        self.assertEqual(parse_ranges('bytes=-5000', 1000), [(0, 999)])
+        self.assertEqual(parse_ranges('bytes=500-5000', 1000), [(500, 999)])
+
+    def test_ranges_are_sorted_and_merged(self):
+        self.assertEqual(parse_ranges('bytes=500-599,0-99,100-199', 1000), [(0, 199), (500, 599)])
+        self.assertEqual(parse_ranges('bytes=0-50,40-60', 1000), [(0, 60)])
+
+    def test_unsatisfiable(self):
+        self.assertEqual(parse_ranges('bytes=1000-', 1000), [])
+        self.assertEqual(parse_ranges('bytes=2000-3000', 1000), [])
+
+    def test_ignored_headers(self):
+        for header in (None, '', 'items=0-1', 'bytes=abc', 'bytes=-', 'bytes=10-5'):
+            self.assertIsNone(parse_ranges(header, 1000), header)
+        self.assertIsNone(parse_ranges('bytes=0-1', 0))
+        too_many = 'bytes=' + ','.join(f'{n * 10}-{n * 10 + 1}' for n in range(17))
+        self.assertIsNone(parse_ranges(too_many, 1000))
+
+    def test_multipart_length_matches_body(self):
+        data = bytes(range(256)) * 8
+        with tempfile.NamedTemporaryFile(delete=False) as f:
+            f.write(data)
+        self.addCleanup(os.remove, f.name)
+        ranges = parse_ranges('bytes=0-9,100-199,-50', len(data))
+        body = b''.join(iter_multipart(f.name, ranges, len(data), 'video/mp4', 'BOUNDARY', 64))
+        self.assertEqual(len(body), multipart_length(ranges, len(data), 'video/mp4', 'BOUNDARY'))
+        self.assertIn(data[100:200], body)
+        self.assertTrue(body.endswith(b'--BOUNDARY--\r\n'))
+
+
+class MediaKeyTests(TestCase):
+    def test_youtube_url_forms_share_a_key(self):
+        key = media_key('https://www.youtube.com/watch?v=dQw4w9WgXcQ', 'video')
+        for url in (
+            'https://youtu.be/dQw4w9WgXcQ',
+            'https://youtu.be/dQw4w9WgXcQ?si=abcdef',
+            'https://m.youtube.com/watch?v=dQw4w9WgXcQ',
+            'https://youtube.com/watch?v=dQw4w9WgXcQ&list=PLrAXtmErZgOeiKm4sgNOknGvNjby9efdf&index=3',
+        ):
+            self.assertEqual(media_key(url, 'video'), key, url)
+
+    def test_different_media_differ(self):
+        key = media_key('https://www.youtube.com/watch?v=dQw4w9WgXcQ', 'video')
+        self.assertNotEqual(media_key('https://www.youtube.com/watch?v=9bZkp7q19f0', 'video'), key)
+        self.assertNotEqual(media_key('https://www.youtube.com/watch?v=dQw4w9WgXcQ', 'audio'), key)
+
+    def test_generic_urls_are_normalized(self):
+        key = media_key('https://example.com/media/clip.mp4?b=2&a=1', 'video')
+        self.assertEqual(media_key('https://WWW.Example.com/media/clip.mp4?a=1&b=2&utm_source=x#t=5', 'video'), key)
+        self.assertNotEqual(media_key('https://example.com/media/other.mp4', 'video'), key)
+
+
+class ZipArchiveTests(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def write(self, name, data):
+        path = os.path.join(self.dir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_archive_is_valid(self):
+        first = os.urandom(100000)
+        second = b'second file'
+        files = [
+            ('a.mp4', self.write('a.mp4', first), len(first)),
+            ('b.mp3', self.write('b.mp3', second), None),  # size unknown: ZIP64 entry
+            ('gone.mp4', os.path.join(self.dir, 'gone.mp4'), 10),
+        ]
+        chunks = list(iter_zip(files, 4096))
+        with zipfile.ZipFile(io.BytesIO(b''.join(chunks))) as archive:
+            self.assertIsNone(archive.testzip())
+            self.assertEqual(archive.namelist(), ['a.mp4', 'b.mp3'])
+            self.assertEqual(archive.read('a.mp4'), first)
+            self.assertEqual(archive.read('b.mp3'), second)
+        # Streamed as it is written rather than in one piece
+        self.assertGreater(len([chunk for chunk in chunks if chunk]), 2)
+
+    def test_duplicate_names_are_numbered(self):
+        taken = set()
+        names = [unique_name(name, taken) for name in ('clip.mp4', 'Clip.mp4', 'clip.mp4', 'a/b.mp4', 'clip')]
+        self.assertEqual(names, ['clip.mp4', 'Clip (2).mp4', 'clip (3).mp4', 'a_b.mp4', 'clip'])
+
+
+@override_settings(VIDEO_DOWNLOADER=dict(
+    settings.VIDEO_DOWNLOADER,
+    MAX_DOWNLOADS_PER_DOMAIN_PER_5MIN=3,
+    MAX_CONCURRENT_DOWNLOADS_PER_DOMAIN=2,
+    MIN_DELAY_BETWEEN_DOWNLOADS=10,
+    MIN_DELAY_JITTER=(0, 0),
+    BURST_SIZE=2,
+    BURST_COOLDOWN=(30, 30),
+))
+class LimiterScriptTests(RedisTestCase):
+    """Runs the Lua scripts against Redis"""
+
+    def setUp(self):
+        super().setUp()
+        self.domain = f'{uuid()}.test'
+
+    def active(self):
+        return get_redis().zrange(limiter.ACTIVE_PREFIX + self.domain, 0, -1)
+
+    def test_concurrency_limit(self):
+        self.assertTrue(limiter.admit(self.domain, 'a')[0])
+        self.assertTrue(limiter.admit(self.domain, 'b')[0])
+        allowed, reason, retry_after = limiter.admit(self.domain, 'c')
+        self.assertFalse(allowed)
+        self.assertEqual(reason, 'concurrency')
+        # Bounded by the spacing between downloads, not the ~330 s lease
+        self.assertGreater(retry_after, 0)
+        self.assertLessEqual(retry_after, 10)
+
+        limiter.release(self.domain, 'a')
+        self.assertTrue(limiter.admit(self.domain, 'c')[0])
+        self.assertCountEqual(self.active(), ['b', 'c'])
+
+    def test_token_bucket(self):
+        for task_id in ('a', 'b', 'c'):
+            self.assertTrue(limiter.admit(self.domain, task_id)[0])
+            limiter.release(self.domain, task_id)
+        allowed, reason, retry_after = limiter.admit(self.domain, 'd')
+        self.assertFalse(allowed)
+        self.assertEqual(reason, 'rate')
+        # One token comes back every 100 seconds
+        self.assertAlmostEqual(retry_after, 100, delta=1)
+
+    def test_admitted_task_is_not_charged_twice(self):
+        self.assertTrue(limiter.admit(self.domain, 'a')[0])
+        self.assertTrue(limiter.admit(self.domain, 'a')[0])
+        self.assertTrue(limiter.admit(self.domain, 'b')[0])
+        limiter.release(self.domain, 'a')
+        self.assertTrue(limiter.admit(self.domain, 'c')[0])
+
+    def test_hold(self):
+        limiter.hold(self.domain, 'a', extend_only=True)
+        self.assertEqual(self.active(), [])
+        limiter.hold(self.domain, 'a')
+        self.assertEqual(self.active(), ['a'])
+        r = get_redis()
+        r.zadd(limiter.ACTIVE_PREFIX + self.domain, {'a': 1})
+        limiter.hold(self.domain, 'a', extend_only=True)
+        self.assertGreater(r.zscore(limiter.ACTIVE_PREFIX + self.domain, 'a'), 1)
+
+    def test_slots_are_spaced_with_burst_cooldown(self):
+        waits = [limiter.reserve_slot(self.domain, 3600) for _ in range(4)]
+        self.assertTrue(all(booked for booked, _ in waits))
+        expected = [0, 10, 50, 60]  # the third start is after BURST_SIZE and waits BURST_COOLDOWN
+        for (_, wait), want in zip(waits, expected):
+            self.assertAlmostEqual(wait, want, delta=1)
+
+    def test_slots_are_not_booked_past_max_ahead(self):
+        limiter.reserve_slot(self.domain, 15)
+        limiter.reserve_slot(self.domain, 15)
+        booked, wait = limiter.reserve_slot(self.domain, 15)
+        self.assertFalse(booked)
+        self.assertAlmostEqual(wait, 35, delta=1)
+        # Nothing was booked, so a request allowed further ahead gets the same slot
+        self.assertAlmostEqual(limiter.reserve_slot(self.domain, 3600)[1], 50, delta=1)
+
+
+class SingleflightTests(RedisTestCase):
+    def test_identical_requests_share_a_task(self):
+        self.assertEqual(singleflight.claim('key', 'first'), 'first')
+        self.assertEqual(singleflight.claim('key', 'second'), 'first')
+
+    def test_only_the_owner_releases(self):
+        singleflight.claim('key', 'first')
+        singleflight.release('key', 'second')
+        self.assertEqual(singleflight.claim('key', 'third'), 'first')
+        singleflight.release('key', 'first')
+        self.assertEqual(singleflight.claim('key', 'third'), 'third')
+
+    def test_refresh_extends_only_the_owners_claim(self):
+        self.config(INFLIGHT_TTL=60)
+        singleflight.claim('key', 'first')
+        singleflight.refresh('key', 'second', 3600)
+        self.assertLessEqual(get_redis().ttl(singleflight.INFLIGHT_PREFIX + 'key'), 60)
+        singleflight.refresh('key', 'first', 600)
+        self.assertGreater(get_redis().ttl(singleflight.INFLIGHT_PREFIX + 'key'), 600)
+
+    def test_task_lock(self):
+        self.assertTrue(singleflight.lock_task('task', 'a'))
+        self.assertFalse(singleflight.lock_task('task', 'b'))
+        singleflight.unlock_task('task', 'b')
+        self.assertFalse(singleflight.lock_task('task', 'b'))
+        singleflight.unlock_task('task', 'a')
+        self.assertTrue(singleflight.lock_task('task', 'b'))
+
+    def test_unfinished_runs_are_counted(self):
+        self.assertEqual(singleflight.begin_run('task'), 1)
+        self.assertEqual(singleflight.begin_run('task'), 2)
+        singleflight.end_run('task')
+        self.assertEqual(singleflight.begin_run('task'), 1)
+
+
+class MetadataTests(RedisTestCase):
+    def setUp(self):
+        super().setUp()
+        self.config(
+            EXTRA_EXTRACTORS=['downloader.bench.BenchIE'],
+            INFO_CACHE={'TTL': 600, 'MAX_BYTES': 1024 ** 2},
+        )
+        self.server, self.base_url = start_server()
+        self.addCleanup(self.server.shutdown)
+        self.url = f'{self.base_url}/bench/progressive/clip?size=65536'
+
+    def test_store_and_lookup(self):
+        metadata.store(self.url, {'_type': 'video', 'title': 'clip'})
+        self.assertEqual(metadata.lookup(self.url), {'_type': 'video', 'title': 'clip'})
+        metadata.forget(self.url)
+        self.assertIsNone(metadata.lookup(self.url))
+        self.assertEqual(int(get_redis().get(metadata.BYTES_KEY)), 0)
+
+    def test_expired_entries_are_dropped(self):
+        metadata.store(self.url, {'title': 'clip'})
+        get_redis().zadd(metadata.CREATED_KEY, {metadata.info_key(self.url): time.time() - 601})
+        self.assertIsNone(metadata.lookup(self.url))
+
+    def test_oldest_entries_are_evicted_over_max_bytes(self):
+        self.config(INFO_CACHE={'TTL': 600, 'MAX_BYTES': 1000})
+        urls = [f'{self.base_url}/bench/progressive/clip{n}?size=65536' for n in range(3)]
+        for url in urls:
+            metadata.store(url, {'title': 'x' * 400})
+        self.assertIsNone(metadata.lookup(urls[0]))
+        self.assertIsNotNone(metadata.lookup(urls[2]))
+        self.assertLessEqual(int(get_redis().get(metadata.BYTES_KEY)), 1000)
+
+    def test_fetch_extracts_once(self):
+        with mock.patch.object(metadata, 'extract', wraps=metadata.extract) as extract:
+            info = metadata.fetch(self.url)
+            self.assertEqual(metadata.fetch(self.url), info)
+        self.assertEqual(extract.call_count, 1)
+        self.assertEqual(metadata.summary(info)['formats'][0]['format_id'], 'progressive')
+        # The extraction's concurrency lease is given back
+        self.assertEqual(get_redis().zcard(limiter.ACTIVE_PREFIX + extract_domain(self.url)), 0)
+
+    def test_fetch_is_rate_limited(self):
+        self.config(MAX_CONCURRENT_DOWNLOADS_PER_DOMAIN=1)
+        limiter.admit(extract_domain(self.url), 'running')
+        with self.assertRaises(RateLimited):
+            metadata.fetch(self.url)
+
+    def test_failed_replay_extracts_again(self):
+        downloads = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, downloads)
+        self.enterContext(override_settings(BASE_DIR=downloads))
+
+        # Format URLs of a cached preview that stopped working
+        info = metadata.extract(self.url)
+        for fmt in info['formats']:
+            fmt['url'] = fmt['url'].replace('/media/', '/gone/')
+        info['url'] = info['formats'][0]['url']
+        metadata.store(self.url, info)
+
+        result = download_video_task.apply(args=(self.url, 'video')).get()
+        self.assertEqual(result['status'], 'success', result)
+        self.assertEqual(result['size'], 65536)
+        self.assertIsNone(metadata.lookup(self.url))
+
+
+class DispatchViewTests(RedisTestCase):
+    url = 'https://example.com/media/clip.mp4'
+    steps = settings.CELERY_BROKER_TRANSPORT_OPTIONS['priority_steps']
+
+    def setUp(self):
+        super().setUp()
+        # Nothing is sent to the broker, and its queues count as empty
+        self.enterContext(mock.patch('celery.canvas.Signature.apply_async'))
+        self.enterContext(mock.patch.object(
+            admission, 'priority_depths', lambda queues: {queue: dict.fromkeys(self.steps, 0) for queue in queues}))
+
+    def submit(self, url=None):
+        return self.client.post('/', {'url': url or self.url, 'media_type': 'video'}, content_type='application/json')
+
+    def test_queued_then_coalesced(self):
+        first = self.submit()
+        self.assertEqual(first.status_code, 200)
+        second = self.submit()
+        self.assertEqual(second.json(), {'task_id': first.json()['task_id'], 'coalesced': True})
+        self.assertEqual(Download.objects.get().state, Download.QUEUED)
+
+    def test_missing_fields(self):
+        response = self.client.post('/', {'url': self.url}, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_rate_limited(self):
+        self.config(MAX_CONCURRENT_DOWNLOADS_PER_DOMAIN=1, MIN_DELAY_BETWEEN_DOWNLOADS=10)
+        self.assertEqual(self.submit().status_code, 200)
+        response = self.submit(self.url + '?v=2')
+        self.assertEqual(response.status_code, 429)
+        self.assertLessEqual(int(response['Retry-After']), 11)
+        # The refused request's claim was given up, so it can be submitted again later
+        self.assertIsNone(get_redis().get(singleflight.INFLIGHT_PREFIX + request_key(self.url + '?v=2', 'video')))
+
+    def test_overloaded(self):
+        with mock.patch.object(admission, 'admit', side_effect=admission.Overloaded('busy', 42)):
+            response = self.submit()
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '42')
+        self.assertFalse(Download.objects.exists())
+
+    def test_info_is_rate_limited(self):
+        self.config(MAX_CONCURRENT_DOWNLOADS_PER_DOMAIN=1)
+        limiter.admit('example.com', 'running')
+        response = self.client.get('/api/download/info/', {'url': self.url})
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response)
+
+
+class HistoryTests(TestCase):
+    def setUp(self):
+        history.flush()
+        self.rows = [
+            Download.objects.create(task_id=task_id, url='u', key='k', domain='example.com', media_type='video')
+            for task_id in ('a', 'b')
+        ]
+
+    def state(self, task_id):
+        return Download.objects.get(task_id=task_id).state
+
+    @override_settings(VIDEO_DOWNLOADER=dict(settings.VIDEO_DOWNLOADER, HISTORY_FLUSH_SIZE=100, HISTORY_FLUSH_INTERVAL=60))
+    def test_updates_are_buffered(self):
+        history.update('a', state=Download.RUNNING)
+        self.assertEqual(self.state('a'), Download.QUEUED)
+        history.flush()
+        self.assertEqual(self.state('a'), Download.RUNNING)
+
+    @override_settings(VIDEO_DOWNLOADER=dict(settings.VIDEO_DOWNLOADER, HISTORY_FLUSH_SIZE=100, HISTORY_FLUSH_INTERVAL=60))
+    def test_flush_one_task(self):
+        history.update('a', state=Download.RUNNING)
+        history.update('b', state=Download.RUNNING)
+        history.flush(['a'])
+        self.assertEqual(self.state('a'), Download.RUNNING)
+        self.assertEqual(self.state('b'), Download.QUEUED)
+        history.flush()
+        self.assertEqual(self.state('b'), Download.RUNNING)
+
+    @override_settings(VIDEO_DOWNLOADER=dict(settings.VIDEO_DOWNLOADER, HISTORY_FLUSH_SIZE=2, HISTORY_FLUSH_INTERVAL=60))
+    def test_full_buffer_is_flushed(self):
+        history.update('a', state=Download.RUNNING)
+        history.update('b', state=Download.RUNNING)
+        self.assertEqual(self.state('a'), Download.RUNNING)
+        self.assertEqual(self.state('b'), Download.RUNNING)
+
+    def test_finished(self):
+        history.finished('a', {'status': 'success', 'file_path': '/x/clip.mp4', 'filename': 'clip.mp4', 'size': 10})
+        history.finished('b', {'status': 'error', 'error': 'Download stalled'})
+        history.flush()
+        a, b = Download.objects.get(task_id='a'), Download.objects.get(task_id='b')
+        self.assertEqual((a.state, a.bytes, a.filename), (Download.SUCCESS, 10, 'clip.mp4'))
+        self.assertEqual((b.state, b.error), (Download.FAILED, 'Download stalled'))
+
+
+class AdmissionTests(RedisTestCase):
+    queue = 'downloads.default'
+
+    def setUp(self):
+        super().setUp()
+        self.ready = dict.fromkeys(settings.CELERY_BROKER_TRANSPORT_OPTIONS['priority_steps'], 0)
+        self.enterContext(mock.patch.object(admission, 'priority_depths', lambda queues: {self.queue: self.ready}))
+        self.config(ADMISSION={
+            'MAX_QUEUE_WAIT': 60, 'MAX_QUEUE_DEPTH': 1000, 'RATE_WINDOW': 300, 'MIN_COMPLETIONS': 5, 'RETRY_AFTER': 30,
+        })
+
+    def complete(self, count):
+        for n in range(count):
+            admission.record_completion(self.queue, f'task-{n}')
+
+    def test_unknown_rate(self):
+        self.ready[4] = 10
+        self.complete(4)
+        self.assertIsNone(admission.admit(self.queue, 4))
+
+    def test_estimate_counts_only_messages_served_first(self):
+        self.complete(5)  # within a second: 5 per second
+        self.ready.update({2: 10, 4: 10, 7: 100})
+        self.assertAlmostEqual(admission.admit(self.queue, 4), 4, delta=0.5)
+        self.assertAlmostEqual(admission.admit(self.queue, 2), 2, delta=0.5)
+
+    def test_deferred_runs_count_until_they_start(self):
+        self.complete(5)
+        for n in range(10):
+            admission.deferred(self.queue, 4, f'deferred-{n}', 120)
+        self.assertAlmostEqual(admission.admit(self.queue, 4), 2, delta=0.5)
+        for n in range(10):
+            admission.started(self.queue, f'deferred-{n}')
+        self.assertEqual(admission.admit(self.queue, 4), 0)
+
+    def test_overloaded(self):
+        self.complete(5)
+        self.ready[4] = 400  # 80 seconds at 5 per second
+        with self.assertRaises(admission.Overloaded) as raised:
+            admission.admit(self.queue, 4)
+        self.assertAlmostEqual(raised.exception.retry_after, 20, delta=1)
+
+    def test_queue_full(self):
+        self.ready[4] = 1000
+        with self.assertRaises(admission.Overloaded) as raised:
+            admission.admit(self.queue, 9)
+        self.assertEqual(raised.exception.retry_after, 30)
+
+
+class TuningTests(RedisTestCase):
+    MB = 1024 * 1024
+
+    def test_fragment_levels(self):
+        self.assertEqual(tuning.fragment_levels(8), [1, 2, 4, 8])
+        self.assertEqual(tuning.fragment_levels(6), [1, 2, 4, 6])
+        self.assertEqual(tuning.fragment_levels(1), [1])
+
+    def test_chunk_size(self):
+        config = settings.VIDEO_DOWNLOADER['TUNING']
+        self.assertEqual(tuning.chunk_size_for(None, config), config['DEFAULT_CHUNK_SIZE'])
+        self.assertEqual(tuning.chunk_size_for(100, config), config['MIN_CHUNK_SIZE'])
+        self.assertEqual(tuning.chunk_size_for(3 * self.MB, config), 4 * self.MB)
+        self.assertEqual(tuning.chunk_size_for(1000 * self.MB, config), config['MAX_CHUNK_SIZE'])
+
+    def test_small_samples_are_ignored(self):
+        self.assertIsNone(tuning.record('example.com', {'fragments': 4}, [(1000, 1, True)]))
+        self.assertEqual(tuning.measured('example.com'), {})
+
+    def test_throughput_is_smoothed(self):
+        tuning.record('example.com', {'fragments': 4}, [(10 * self.MB, 1, True)])
+        tuning.record('example.com', {'fragments': 4}, [(20 * self.MB, 1, True)])
+        tuning.record('example.com', {'fragments': 4}, [(10 * self.MB, 1, False)])
+        stats = tuning.measured('example.com')
+        self.assertAlmostEqual(stats['f4'], 13 * self.MB)
+        self.assertAlmostEqual(stats['http'], 10 * self.MB)
+
+    def test_choose_explores_neighbours_then_keeps_the_fastest(self):
+        self.assertEqual(tuning.choose('example.com')['fragments'], 4)
+        tuning.record('example.com', {'fragments': 4}, [(10 * self.MB, 1, True)])
+        self.assertEqual(tuning.choose('example.com')['fragments'], 8)
+        tuning.record('example.com', {'fragments': 8}, [(5 * self.MB, 1, True)])
+        self.assertEqual(tuning.choose('example.com')['fragments'], 2)
+        tuning.record('example.com', {'fragments': 2}, [(5 * self.MB, 1, True)])
+        with mock.patch.object(tuning.random, 'random', return_value=1):
+            self.assertEqual(tuning.choose('example.com'), {'fragments': 4, 'chunk_size': 16 * self.MB})
+
+
+class QuotaTests(RedisTestCase):
+    def setUp(self):
+        super().setUp()
+        self.base = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.base)
+        self.enterContext(override_settings(BASE_DIR=self.base))
+
+    def write(self, task_id, name, size=10, age=0):
+        path = os.path.join(quota.task_dir(task_id), name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(b'x' * size)
+        if age:
+            os.utime(path, (time.time() - age, time.time() - age))
+        return path
+
+    def test_least_recently_used_files_are_evicted(self):
+        self.config(DISK_QUOTA_BYTES=25)
+        paths = [self.write(f'{n:02x}task', 'clip.mp4') for n in range(3)]
+        for n, path in enumerate(paths):
+            quota.register(path, f'task{n}', last_access=time.time() - 100 + n)
+        quota.touch(paths[0])
+        self.assertEqual(quota.enforce(), 1)
+        self.assertEqual([os.path.exists(path) for path in paths], [True, False, True])
+        self.assertEqual(int(get_redis().get(quota.BYTES_KEY)), 20)
+        # The evicted file's now empty task directory goes with it
+        self.assertFalse(os.path.exists(os.path.dirname(paths[1])))
+
+    def test_maintain(self):
+        self.config(PARTIAL_FILE_GRACE=60, MAINTENANCE_SHARDS_PER_PASS=256)
+        live, dead, done = (prefix * 16 for prefix in ('aa', 'bb', 'cc'))
+        live_files = [self.write(live, 'clip.f137.mp4', age=3600), self.write(live, 'clip.mp4.part', age=3600)]
+        dead_files = [self.write(dead, 'clip.f137.mp4', age=3600), self.write(dead, 'clip.mp4.part', age=3600)]
+        recent = self.write(dead, 'clip.f140.m4a')
+        output = self.write(done, 'clip.mp4', age=3600)
+        Download.objects.create(
+            task_id=done, url='u', key='k', domain='example.com', media_type='video',
+            state=Download.SUCCESS, file_path=output)
+        singleflight.lock_task(live, 'token')
+
+        stats = quota.maintain()
+        self.assertEqual(stats, {'indexed': 1, 'partials_removed': 2, 'evicted': 0})
+        self.assertTrue(all(os.path.exists(path) for path in live_files))
+        self.assertFalse(any(os.path.exists(path) for path in dead_files))
+        self.assertTrue(os.path.exists(recent))
+        self.assertTrue(get_redis().hexists(quota.FILES_KEY, output))
+
+
+class WatchdogTests(TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.enterContext(mock.patch.object(watchdog.time, 'monotonic', lambda: self.now))
+        self.enterContext(override_settings(VIDEO_DOWNLOADER=dict(
+            settings.VIDEO_DOWNLOADER, STALL_WINDOW=30, STALL_MIN_SPEED=1000)))
+        self.hook = watchdog.make_stall_hook()
+
+    def progress(self, seconds, downloaded):
+        self.now += seconds
+        self.hook({'status': 'downloading', 'filename': 'clip.mp4', 'downloaded_bytes': downloaded, 'elapsed': 0})
+
+    def test_steady_transfer(self):
+        for n in range(1, 10):
+            self.progress(10, n * 20000)
+
+    def test_stall_is_detected(self):
+        self.progress(0, 0)
+        self.progress(20, 10000)
+        with self.assertRaises(watchdog.Stalled):
+            self.progress(11, 20000)
+
+    def test_restarted_transfer_starts_a_new_window(self):
+        self.progress(0, 50000)
+        self.progress(29, 0)
+        self.progress(29, 10000)
+
+    def test_finished_files_are_ignored(self):
+        self.now += 3600
+        self.hook({'status': 'finished', 'filename': 'clip.mp4', 'downloaded_bytes': 0})
@@ -0,0 +1,100 @@
+import random
+
+from django.conf import settings
+
+from .redis_client import get_redis
+
+STATS_PREFIX = 'downloader:tuning:'  # per-domain hash: 'f<n>' or 'http' -> smoothed bytes/s
+
+def fragment_levels(limit):
+    """Fragment parallelism tried per domain: 1, 2, 4, ... up to limit"""
+    levels = [1]
+    while levels[-1] * 2 <= limit:
+        levels.append(levels[-1] * 2)
+    if levels[-1] != limit:
+        levels.append(limit)
+    return levels
+
+def measured(domain):
+    """Smoothed throughput per setting recorded for a domain"""
+    return {field: float(value) for field, value in get_redis().hgetall(STATS_PREFIX + domain).items()}
+
+def chunk_size_for(throughput, config):
+    """Largest power of two within the limits that takes about CHUNK_SECONDS to fetch"""
+    if not throughput:
+        return config['DEFAULT_CHUNK_SIZE']
+    size = config['MIN_CHUNK_SIZE']
+    while size * 2 <= min(throughput * config['CHUNK_SECONDS'], config['MAX_CHUNK_SIZE']):
+        size *= 2
+    return size
+
+def choose(domain):
+    """Fragment parallelism and HTTP chunk size for the next download from a domain.
+
+    Starts at DEFAULT_FRAGMENTS, tries the neighbouring levels once each, then keeps
+    the fastest level seen, re-checking a neighbour now and then as conditions change.
+    """
+    config = settings.VIDEO_DOWNLOADER['TUNING']
+    levels = fragment_levels(config['MAX_FRAGMENTS'])
+    stats = measured(domain)
+    by_level = {level: stats[f'f{level}'] for level in levels if f'f{level}' in stats}
+
+    if not by_level:
+        fragments = min(config['DEFAULT_FRAGMENTS'], levels[-1])
+    else:
+        best = max(by_level, key=by_level.get)
+        index = levels.index(best)
+        neighbours = levels[max(index - 1, 0):index] + levels[index + 1:index + 2]
+        untried = [level for level in neighbours if level not in by_level]
+        if untried:
+            fragments = untried[-1]
+        elif neighbours and random.random() < config['EXPLORE']:
+            fragments = random.choice(neighbours)
+        else:
+            fragments = best
+
+    throughput = max(stats.values(), default=None)
+    return {'fragments': fragments, 'chunk_size': chunk_size_for(throughput, config)}
+
+def ydl_options(params):
+    return {
+        'concurrent_fragment_downloads': params['fragments'],
+        'http_chunk_size': params['chunk_size'],
+    }
+
+def make_meter_hook(samples):
+    """yt-dlp progress hook that collects (bytes, seconds, fragmented) per finished file"""
+    def hook(d):
+        if d['status'] == 'finished' and d.get('elapsed'):
+            samples.append((d.get('total_bytes') or d.get('downloaded_bytes') or 0, d['elapsed'], bool(d.get('fragment_count'))))
+    return hook
+
+def fragmented(samples):
+    return any(is_fragmented for _, _, is_fragmented in samples)
+
+def totals(samples):
+    """(bytes, seconds) transferred over all finished files"""
+    return sum(size for size, _, _ in samples), sum(elapsed for _, elapsed, _ in samples)
+
+def record(domain, params, samples):
+    """Fold a finished download's throughput into the domain's stats; returns bytes/s or None"""
+    config = settings.VIDEO_DOWNLOADER['TUNING']
+    total, seconds = totals(samples)
+    # Small files mostly measure connection setup
+    if total < config['MIN_SAMPLE_BYTES'] or seconds <= 0:
+        return None
+    throughput = total / seconds
+
+    # Progressive files are a single stream, so fragment parallelism says nothing about them
+    field = f"f{params['fragments']}" if fragmented(samples) else 'http'
+    key = STATS_PREFIX + domain
+    r = get_redis()
+    # Concurrent updates may drop a sample, which smoothing makes harmless
+    previous = r.hget(key, field)
+    alpha = config['SMOOTHING']
+    value = throughput if previous is None else alpha * throughput + (1 - alpha) * float(previous)
+    pipe = r.pipeline()
+    pipe.hset(key, field, value)
+    pipe.expire(key, config['STATS_TTL'])
+    pipe.execute()
+    return throughput
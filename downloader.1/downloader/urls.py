@@ -6,6 +6,14 @@ from . import views
 urlpatterns = [
     path('api/download/', views.index, name='index'),  # Home page for the downloader form
     path('', views.start_download, name='start_download'),
+    path('api/download/status/', views.bulk_status, name='bulk_status'),
     path('api/download/status/<str:task_id>/', views.check_status, name='check_status'),
     path('api/download/file/<str:task_id>/', views.download_file, name='download_file'),
+    path('api/download/info/', views.media_info, name='media_info'),
+    path('api/download/archive/', views.download_archive, name='download_archive'),
+    path('api/download/progress/<str:task_id>/', views.stream_progress, name='stream_progress'),
+    path('api/download/batch/', views.start_batch, name='start_batch'),
+    path('api/download/batch/<str:batch_id>/', views.batch_status, name='batch_status'),
+    path('api/download/batch/<str:batch_id>/archive/', views.batch_archive, name='batch_archive'),
+    path('metrics', views.metrics_view, name='metrics'),
     ] + static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
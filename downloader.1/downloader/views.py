@@ -1,134 +1,365 @@
-from django.http import FileResponse
+from asgiref.sync import sync_to_async
+from celery import states
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render
+from django.utils.http import content_disposition_header
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_http_methods
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
+import asyncio
+import json
+import yt_dlp
+from datetime import timedelta
 import os
-import glob
+import mimetypes
 import time
-from .tasks import download_video_task
+from .tasks import expand_batch_task
+from . import admission, archive, cache, dispatch, metadata, metrics, progress, quota, routing, status
+from .redis_client import get_redis
+from .models import Download
+from .serializers import BatchDownloadRequestSerializer, BulkStatusRequestSerializer, DownloadRequestSerializer
+from .serving import in_thread
+from .storage import get_storage
 from celery.result import AsyncResult
+from celery.utils import uuid
 from django.conf import settings
+from django.utils import timezone
 
 
-active_downloads = {}
-download_history = {}
-
-def cleanup_partial_files():
-    """Clean up any .part files in the downloads directory"""
-    downloads_dir = os.path.join(settings.BASE_DIR, 'downloads')
-    if os.path.exists(downloads_dir):
-        part_files = glob.glob(os.path.join(downloads_dir, '*.part'))
-        for part_file in part_files:
-            try:
-                os.remove(part_file)
-                print(f"Cleaned up partial file: {part_file}")
-            except Exception as e:
-                print(f"Failed to remove {part_file}: {e}")
-
-def extract_domain_from_url(url):
-    """Extract domain for tracking"""
-    if 'youtube.com' in url or 'youtu.be' in url:
-        return 'youtube'
-    elif 'tiktok.com' in url:
-        return 'tiktok'
-    elif 'twitter.com' in url or 'x.com' in url:
-        return 'twitter'
-    elif 'instagram.com' in url:
-        return 'instagram'
-    else:
-        return 'other'
+def request_data(request):
+    """Fields of a JSON or form POST body (None if the JSON is malformed)"""
+    if request.content_type == 'application/json':
+        try:
+            data = json.loads(request.body or b'{}')
+        except ValueError:
+            return None
+        return data if isinstance(data, dict) else None
+    return request.POST
 
 @csrf_exempt
-@api_view(['POST', 'GET'])
-def start_download(request):
+@require_http_methods(['POST', 'GET'])
+async def start_download(request):
     if request.method == 'GET':
-        # Clean up any partial files before showing the page
-        cleanup_partial_files()
         return render(request, 'home.html')
-    
-    url = request.data.get('url')
-    media_type = request.data.get('media_type')
+
+    data = request_data(request)
+    if data is None:
+        return JsonResponse({'message': 'Malformed JSON body'}, status=400)
+    url = data.get('url')
+    media_type = data.get('media_type')
 
     if not url or not media_type:
-        return Response({'message': 'Missing URL or media_type'}, status=400)
-
-    # Check rate limiting
-    domain = extract_domain_from_url(url)
-    current_time = time.time()
-    
-    # Check if too many recent downloads from this domain
-    if domain in download_history:
-        recent_downloads = [t for t in download_history[domain] if current_time - t < 300]  # 5 minutes
-        if len(recent_downloads) >= 5:  # Max 5 downloads per 5 minutes per domain
-            return Response({
-                'message': f'Rate limit exceeded for {domain}. Please wait a few minutes before trying again.'
-            }, status=429)
-    
-    # Check if there's an active download from the same domain
-    active_domain_downloads = [d for d in active_downloads.values() if d['domain'] == domain and current_time - d['start_time'] < 120]  # 2 minutes
-    if len(active_domain_downloads) >= 2:  # Max 2 concurrent downloads per domain
-        return Response({
-            'message': f'Too many active downloads from {domain}. Please wait for current downloads to complete.'
-        }, status=429)
-
-    task = download_video_task.delay(url, media_type)
-    
-    # Track the download
-    active_downloads[task.id] = {
-        'domain': domain,
-        'start_time': current_time,
-        'url': url
-    }
-    
-    # Add to history
-    if domain not in download_history:
-        download_history[domain] = []
-    download_history[domain].append(current_time)
-    
-    # Clean old history (keep only last 24 hours)
-    download_history[domain] = [t for t in download_history[domain] if current_time - t < 86400]
-    
-    return Response({'task_id': task.id})
+        return JsonResponse({'message': 'Missing URL or media_type'}, status=400)
+    audio_format = data.get('audio_format')
+    if audio_format and audio_format not in settings.VIDEO_DOWNLOADER['AUDIO_FORMATS']:
+        return JsonResponse({'message': f'Unsupported audio_format: {audio_format}'}, status=400)
 
-@csrf_exempt
-@api_view(['GET'])
-def check_status(request, task_id):
-    task = AsyncResult(task_id)
-    
-    # Clean up from active downloads if completed
-    if task_id in active_downloads and task.state in ['SUCCESS', 'FAILURE']:
-        del active_downloads[task_id]
-
-    if task.state == 'PENDING':
-        return Response({'status': 'pending'})
-    elif task.state == 'FAILURE':
-        return Response({'status': 'failed', 'error': str(task.info)})
-    elif task.state == 'SUCCESS':
-        result = task.result
-        if result.get('status') == 'success' and os.path.exists(result.get('file_path')):
+    # Admission and publishing use the sync Redis and broker clients, so they run in
+    # executor threads rather than Django's single thread for sync code
+    try:
+        task_id, how, signature, row, wait = await sync_to_async(dispatch.prepare, thread_sensitive=False)(
+            url, media_type, audio_format=audio_format)
+    except admission.Overloaded as e:
+        response = JsonResponse({'message': str(e)}, status=503)
+        response['Retry-After'] = str(e.retry_after)
+        return response
+    except dispatch.RateLimited as e:
+        response = JsonResponse({'message': str(e)}, status=429)
+        response['Retry-After'] = str(int(e.retry_after) + 1)
+        return response
+
+    if row:
+        await row.asave()
+
+    if how == 'cached':
+        download_url = request.build_absolute_uri(f"/api/download/file/{task_id}/")
+        return JsonResponse({'task_id': task_id, 'download_url': download_url, 'cached': True})
+    elif how == 'coalesced':
+        return JsonResponse({'task_id': task_id, 'coalesced': True})
+
+    await sync_to_async(signature.apply_async, thread_sensitive=False)()
+    if wait is None:
+        return JsonResponse({'task_id': task_id})
+    return JsonResponse({
+        'task_id': task_id,
+        'estimated_wait': round(wait),
+        'estimated_start': (timezone.now() + timedelta(seconds=wait)).isoformat(),
+    })
+
+@require_GET
+async def media_info(request):
+    """Title, thumbnail, duration and formats of a URL, without downloading it"""
+    url = request.GET.get('url')
+    if not url:
+        return JsonResponse({'message': 'Missing URL'}, status=400)
+    try:
+        info = await sync_to_async(metadata.fetch, thread_sensitive=False)(url)
+    except dispatch.RateLimited as e:
+        response = JsonResponse({'message': str(e)}, status=429)
+        response['Retry-After'] = str(int(e.retry_after) + 1)
+        return response
+    except yt_dlp.utils.DownloadError as e:
+        return JsonResponse({'message': str(e)}, status=400)
+    return JsonResponse(metadata.summary(info))
+
+async def recorded_download(task_id):
+    """The Download row for a task, used once the result backend has forgotten it"""
+    return await Download.objects.filter(task_id=task_id).afirst()
+
+async def task_status(request, task_id):
+    """Client-facing status of one download task"""
+    meta = await status.read_meta(task_id)
+
+    if meta is None:
+        # No entry also means "unknown": the result may have expired from the backend
+        row = await recorded_download(task_id)
+        if row and row.state == Download.SUCCESS and await get_storage().aexists(row.file_path):
+            download_url = request.build_absolute_uri(f"/api/download/file/{task_id}/")
+            return {'status': 'success', 'download_url': download_url}
+        elif row and row.state == Download.FAILED:
+            return {'status': 'error', 'error': row.error or 'Download failed'}
+        return {'status': 'pending'}
+    elif meta['status'] == states.FAILURE:
+        return {'status': 'failed', 'error': str(meta['result'])}
+    elif meta['status'] == states.SUCCESS:
+        result = meta['result']
+        if result.get('status') == 'success' and await get_storage().aexists(result.get('file_path')):
             download_url = request.build_absolute_uri(f"/api/download/file/{task_id}/")
-            return Response({'status': 'success', 'download_url': download_url})
+            return {'status': 'success', 'download_url': download_url}
         else:
-            return Response({'status': 'error', 'error': result.get('error', 'Download failed or file not found')})
+            return {'status': 'error', 'error': result.get('error', 'Download failed or file not found')}
     else:
-        return Response({'status': task.state.lower()})
+        return {'status': meta['status'].lower()}
+
+@require_GET
+async def check_status(request, task_id):
+    return JsonResponse(await task_status(request, task_id))
+
+@csrf_exempt
+@require_http_methods(['POST'])
+async def bulk_status(request):
+    """States for many tasks at once; with `wait`, block until one differs from `known`"""
+    data = request_data(request)
+    if data is None:
+        return JsonResponse({'message': 'Malformed JSON body'}, status=400)
+    serializer = BulkStatusRequestSerializer(data=data)
+    if not serializer.is_valid():
+        return JsonResponse({'message': 'Invalid status request', 'errors': serializer.errors}, status=400)
+
+    data = serializer.validated_data
+    by_id = await status.wait_for_change(data['task_ids'], data['known'], data['wait'])
+    return JsonResponse({'states': by_id})
+
+@csrf_exempt
+@api_view(['POST'])
+def start_batch(request):
+    serializer = BatchDownloadRequestSerializer(data=request.data)
+    if not serializer.is_valid():
+        return Response({'message': 'Invalid batch request', 'errors': serializer.errors}, status=400)
+
+    # Every entry goes through the same validation as a single download
+    urls = serializer.validated_data['urls']
+    media_type = serializer.validated_data['media_type']
+    items = DownloadRequestSerializer(data=[{'url': url, 'media_type': media_type} for url in urls], many=True)
+    if not items.is_valid():
+        return Response({'message': 'Invalid batch request', 'errors': items.errors}, status=400)
+
+    # Playlist expansion needs the network, so it runs on a worker under the batch's id
+    batch_id = uuid()
+    audio_format = serializer.validated_data.get('audio_format')
+    expand_batch_task.apply_async((urls, media_type, audio_format), task_id=batch_id)
+    status_url = request.build_absolute_uri(f"/api/download/batch/{batch_id}/")
+    return Response({'batch_id': batch_id, 'status_url': status_url}, status=202)
 
 @csrf_exempt
 @api_view(['GET'])
-def download_file(request, task_id):
-    task = AsyncResult(task_id)
-    if not task or task.state != 'SUCCESS':
-        return Response({'message': 'File not ready'}, status=400)
+def batch_status(request, batch_id):
+    batch = AsyncResult(batch_id)
+    if not batch.ready():
+        return Response({'status': 'expanding'})
+    if not batch.successful():
+        return Response({'status': 'failed', 'error': str(batch.info)})
+
+    # All item states come from one bulk read, however large the batch
+    task_ids = list(dict.fromkeys(item['task_id'] for item in batch.result['items'] if item.get('task_id')))
+    by_id = status.read_states(task_ids)
+
+    items = []
+    counts = {'success': 0, 'failed': 0, 'pending': 0}
+    for item in batch.result['items']:
+        if item.get('task_id'):
+            state = by_id[item['task_id']]
+            item = dict(item, status=state['state'])
+            if state['state'] == 'success':
+                item['download_url'] = request.build_absolute_uri(f"/api/download/file/{item['task_id']}/")
+            elif 'error' in state:
+                item['error'] = state['error']
+        if item['status'] == 'success':
+            counts['success'] += 1
+        elif item['status'] in ('failed', 'error'):
+            counts['failed'] += 1
+        else:
+            counts['pending'] += 1
+        items.append(item)
+
+    response = {
+        'status': 'running' if counts['pending'] else 'complete',
+        'total': len(items),
+        'counts': counts,
+        'items': items,
+    }
+    if batch.result.get('truncated'):
+        # Items past MAX_BATCH_SIZE were never queued, so the batch and its archive are incomplete
+        response.update(truncated=True, dropped=batch.result['dropped'])
+    if counts['success']:
+        response['archive_url'] = request.build_absolute_uri(f"/api/download/batch/{batch_id}/archive/")
+    return Response(response)
+
+async def stream_progress(request, task_id):
+    """Server-sent progress events for a task (serve under ASGI)"""
+    response = StreamingHttpResponse(progress.stream(task_id), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # let nginx pass events through unbuffered
+    return response
+
+def follow_file(task_id, output):
+    """Yield a file's bytes as a running task appends them, until the task finishes"""
+    config = settings.VIDEO_DOWNLOADER
+    try:
+        f = open(output['tmpfilename'], 'rb')
+    except FileNotFoundError:
+        # yt-dlp already renamed the .part file to its final name
+        f = open(output['filename'], 'rb')
 
-    result = task.result
+    deadline = time.monotonic() + config['DOWNLOAD_TIMEOUT']
+    with f:
+        while True:
+            chunk = f.read(config['STREAM_CHUNK_SIZE'])
+            if chunk:
+                yield chunk
+                continue
+            # The open handle survives the rename, so EOF only means "nothing new yet"
+            task = AsyncResult(task_id)
+            if task.ready():
+                while chunk := f.read(config['STREAM_CHUNK_SIZE']):
+                    yield chunk
+                if not task.successful() or task.result.get('status') != 'success':
+                    # Break the connection so the client doesn't keep a truncated file
+                    raise IOError(f'Download {task_id} failed while streaming')
+                return
+            if time.monotonic() > deadline:
+                raise IOError(f'Download {task_id} timed out while streaming')
+            time.sleep(config['STREAM_POLL_INTERVAL'])
+
+async def afollow_file(task_id, output):
+    """follow_file for ASGI: reads run in executor threads and polling awaits"""
+    config = settings.VIDEO_DOWNLOADER
+    try:
+        f = open(output['tmpfilename'], 'rb')
+    except FileNotFoundError:
+        # yt-dlp already renamed the .part file to its final name
+        f = open(output['filename'], 'rb')
+
+    deadline = time.monotonic() + config['DOWNLOAD_TIMEOUT']
+    with f:
+        while True:
+            chunk = await asyncio.to_thread(f.read, config['STREAM_CHUNK_SIZE'])
+            if chunk:
+                yield chunk
+                continue
+            # The open handle survives the rename, so EOF only means "nothing new yet"
+            meta = await status.read_meta(task_id)
+            if meta and meta['status'] in states.READY_STATES:
+                while chunk := await asyncio.to_thread(f.read, config['STREAM_CHUNK_SIZE']):
+                    yield chunk
+                if meta['status'] != states.SUCCESS or meta['result'].get('status') != 'success':
+                    # Break the connection so the client doesn't keep a truncated file
+                    raise IOError(f'Download {task_id} failed while streaming')
+                return
+            if time.monotonic() > deadline:
+                raise IOError(f'Download {task_id} timed out while streaming')
+            await asyncio.sleep(config['STREAM_POLL_INTERVAL'])
+
+@require_GET
+async def download_file(request, task_id):
+    meta = await status.read_meta(task_id)
+    if meta is None or meta['status'] != states.SUCCESS:
+        row = await recorded_download(task_id) if meta is None else None
+        if row and row.state == Download.SUCCESS and await get_storage().aexists(row.file_path):
+            await quota.atouch(row.file_path)
+            return get_storage().response(request, row.file_path, row.filename or os.path.basename(row.file_path))
+
+        # ?stream=1 starts sending a single-file download while it is still being written
+        output = await progress.partial_output(task_id) if request.GET.get('stream') else None
+        if output:
+            filename = output['download_name']
+            content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+            chunks = afollow_file(task_id, output) if isinstance(request, ASGIRequest) else follow_file(task_id, output)
+            response = StreamingHttpResponse(chunks, content_type=content_type)
+            response['Content-Disposition'] = content_disposition_header(True, filename)
+            return response
+        return JsonResponse({'message': 'File not ready'}, status=400)
+
+    result = meta['result']
     file_path = result.get('file_path')
 
-    if file_path and os.path.exists(file_path):
-        filename = os.path.basename(file_path)
-        return FileResponse(open(file_path, 'rb'), as_attachment=True, filename=filename)
+    if file_path and await get_storage().aexists(file_path):
+        filename = result.get('filename') or os.path.basename(file_path)
+        await quota.atouch(file_path)
+        return get_storage().response(request, file_path, filename)
     else:
-        return Response({'message': 'File not found'}, status=404)
+        return JsonResponse({'message': 'File not found'}, status=404)
+
+async def archive_response(request, task_ids, filename):
+    """The finished downloads among task_ids as one ZIP, streamed as it is built"""
+    files = await sync_to_async(archive.entries, thread_sensitive=False)(task_ids)
+    if not files:
+        return JsonResponse({'message': 'No finished downloads to archive'}, status=404)
+    chunks = archive.iter_zip(files, settings.VIDEO_DOWNLOADER['STREAM_CHUNK_SIZE'])
+    # Files are read in executor threads under ASGI, as serve_file does
+    response = StreamingHttpResponse(
+        in_thread(chunks) if isinstance(request, ASGIRequest) else chunks, content_type='application/zip')
+    response['Content-Disposition'] = content_disposition_header(True, filename)
+    return response
+
+@require_GET
+async def download_archive(request):
+    """ZIP of the tasks named by ?task_id=...&task_id=..."""
+    task_ids = request.GET.getlist('task_id')
+    if not task_ids:
+        return JsonResponse({'message': 'Missing task_id'}, status=400)
+    limit = settings.VIDEO_DOWNLOADER['MAX_BATCH_SIZE']
+    if len(task_ids) > limit:
+        return JsonResponse({'message': f'At most {limit} tasks per archive.'}, status=400)
+    return await archive_response(request, task_ids, 'downloads.zip')
+
+@require_GET
+async def batch_archive(request, batch_id):
+    """ZIP of every finished download of a batch"""
+    meta = await status.read_meta(batch_id)
+    if meta is None or meta['status'] != states.SUCCESS:
+        return JsonResponse({'message': 'Batch not found or not expanded yet'}, status=404)
+    task_ids = [item['task_id'] for item in meta['result']['items'] if item.get('task_id')]
+    return await archive_response(request, task_ids, f'batch-{batch_id}.zip')
+
+def metrics_view(request):
+    """Prometheus metrics: totals from every process plus live queue depth and disk usage"""
+    r = get_redis()
+    download_queues = [settings.CELERY_TASK_DEFAULT_QUEUE, *settings.VIDEO_DOWNLOADER['QUEUES']]
+    gauges = [
+        ('downloader_queue_depth', 'Tasks waiting in the broker per queue',
+         [({'queue': queue}, depth) for queue, depth in routing.queue_depths().items()]),
+        ('downloader_queue_completion_rate', 'Download runs finished per second, as admission control sees it',
+         [({'queue': queue}, rate) for queue, rate in admission.completion_rates(download_queues).items()
+          if rate is not None]),
+        ('downloader_cache_bytes', 'Bytes of finished downloads kept for reuse',
+         [({}, int(r.get(cache.BYTES_KEY) or 0))]),
+        ('downloader_disk_bytes', 'Bytes of indexed files in storage',
+         [({}, int(r.get(quota.BYTES_KEY) or 0))]),
+    ]
+    return HttpResponse(metrics.render(gauges), content_type='text/plain; version=0.0.4; charset=utf-8')
 
 def index(request):
     return render(request, 'home.html')
\ No newline at end of file
@@ -0,0 +1,31 @@
+import time
+
+from django.conf import settings
+from yt_dlp.utils import DownloadCancelled
+
+class Stalled(DownloadCancelled):
+    """A download moved less than STALL_MIN_SPEED bytes/s for STALL_WINDOW seconds"""
+
+def make_stall_hook():
+    """yt-dlp progress hook that raises Stalled once a file's transfer stays below the floor.
+
+    A connection that delivers nothing at all sends no progress events; socket_timeout
+    (set to the same window) and the task's time limits cover that case.
+    """
+    config = settings.VIDEO_DOWNLOADER
+    window, floor = config['STALL_WINDOW'], config['STALL_MIN_SPEED']
+    marks = {}  # filename -> (time, downloaded bytes) when its current window started
+
+    def hook(d):
+        if d['status'] != 'downloading':
+            return
+        now = time.monotonic()
+        downloaded = d.get('downloaded_bytes') or 0
+        # The first window starts when the transfer did, not at its first (possibly late) event
+        since, base = marks.setdefault(d.get('filename'), (now - (d.get('elapsed') or 0), 0))
+        if downloaded < base or downloaded - base >= floor * window:
+            # Restarted, or enough arrived for this window: start the next one here
+            marks[d.get('filename')] = (now, downloaded)
+        elif now - since >= window:
+            raise Stalled(f'less than {floor} bytes/s for {window} seconds')
+    return hook
@@ -2,6 +2,10 @@
 ASGI config for videodownload project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Serve the project through it (e.g. ``uvicorn videodownload.asgi:application``):
+submit, status, file and progress views are async and use the asyncio Redis
+client, so polls, event streams and slow file transfers don't hold a worker
+thread per client.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/3.0/howto/deployment/asgi/
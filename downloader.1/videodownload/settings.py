@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.0/ref/settings/
 """
 import corsheaders
+from kombu import Queue
 
 import os
 
@@ -44,6 +45,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'downloader.metrics.timing_middleware',  # first, so it times the whole stack
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -142,12 +144,164 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 CELERY_BROKER_URL = 'redis://localhost:6379/0'
 CELERY_RESULT_BACKEND = 'redis://localhost:6379/0'
 
+# Downloads are routed per domain and media type (see VIDEO_DOWNLOADER['QUEUES']);
+# `python manage.py download_workers` prints a worker command for each queue
+CELERY_TASK_ROUTES = ('downloader.routing.route_download',)
+CELERY_TASK_DEFAULT_QUEUE = 'celery'
+CELERY_TASK_DEFAULT_PRIORITY = 4
+# queue_order_strategy stays at its default, round_robin, so a worker consuming several
+# queues rotates between them rather than always draining them in a fixed order
+CELERY_BROKER_TRANSPORT_OPTIONS = {
+    # Each queue is split into one list per step. A worker polls step 0 of all its queues
+    # (in rotating order) before step 1, and so on, so lower values are served first
+    'priority_steps': list(range(10)),
+    'sep': ':',
+    # Unacknowledged tasks (acks_late) go back to the queue after this many seconds;
+    # it must stay above the longest countdown a task is scheduled with
+    'visibility_timeout': 60 * 60,
+}
+# A worker only reserves what it can run, so a slow job can't hold others hostage
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+
+# Run `celery -A videodownload beat` alongside the workers for these
+CELERY_BEAT_SCHEDULE = {
+    'maintain-storage': {
+        'task': 'downloader.tasks.maintain_storage_task',
+        'schedule': 5 * 60,  # seconds
+    },
+}
+
 # Video Downloader Settings
 VIDEO_DOWNLOADER = {
     'MAX_DOWNLOADS_PER_DOMAIN_PER_5MIN': 5,
     'MAX_CONCURRENT_DOWNLOADS_PER_DOMAIN': 2,
     'MIN_DELAY_BETWEEN_DOWNLOADS': 10,  # seconds
-    'DOWNLOAD_TIMEOUT': 300,  # 5 minutes
+    'MIN_DELAY_JITTER': (1, 3),  # seconds added to that delay, picked at random
+    'BURST_SIZE': 20,  # Downloads per domain before a longer pause
+    'BURST_COOLDOWN': (5, 15),  # seconds, picked at random
+    # How far ahead a download may book its start slot; past that it asks again later.
+    # Both stay under the broker's visibility_timeout, after which a countdown is redelivered
+    'MAX_SLOT_AHEAD': 10 * 60,  # seconds
+    'BATCH_MAX_SLOT_AHEAD': 60,  # seconds; batch items never book far ahead of interactive requests
+    'BATCH_ADMIT_INTERVAL': 30,  # most seconds a batch item refused by the limiter waits to ask again
+    'DOWNLOAD_TIMEOUT': 300,  # seconds a download attempt may run (Celery soft time limit)
+    'TIME_LIMIT_GRACE': 30,  # seconds after the soft limit before the worker process is killed
+    'STALL_WINDOW': 30,  # seconds below STALL_MIN_SPEED before a download is aborted; also the socket timeout
+    'STALL_MIN_SPEED': 10 * 1024,  # bytes/s
+    # Interrupted and stalled downloads are retried and resume from their partial files. Keep the
+    # backoff below PARTIAL_FILE_GRACE, or maintenance removes the partials in between.
+    'RETRY_MAX': 5,
+    'RETRY_BACKOFF': 5,  # seconds before the first retry, doubled for each further one
+    'RETRY_BACKOFF_MAX': 10 * 60,  # seconds
+    'TASK_LOCK_TTL': 5 * 60,  # seconds a crashed worker keeps a task's files locked
+    # A redelivered task whose runs keep killing the worker process (crash, OOM, hard
+    # time limit) fails after this many runs in a row end that way
+    'MAX_WORKER_LOSSES': 3,
+    'REDIS_URL': None,  # Shared state (cache, limits); defaults to CELERY_BROKER_URL
+    # Dotted paths to extra yt-dlp extractor classes, tried before the built-in ones
+    'EXTRA_EXTRACTORS': [],
+    'FORMATS': {
+        'video': 'best[height<=720]/best',
+        'audio': 'bestaudio[ext=m4a]/bestaudio/best',
+    },
+    # Per-domain download tuning, picked from measured throughput (see downloader.tuning)
+    'TUNING': {
+        'MAX_FRAGMENTS': 8,  # HLS/DASH fragments fetched in parallel, at most
+        'DEFAULT_FRAGMENTS': 4,  # until a domain has measurements
+        'MIN_CHUNK_SIZE': 1024 * 1024,  # bytes per HTTP range request
+        'MAX_CHUNK_SIZE': 16 * 1024 * 1024,
+        'DEFAULT_CHUNK_SIZE': 4 * 1024 * 1024,
+        'CHUNK_SECONDS': 2,  # chunks sized to about this much transfer time
+        'EXPLORE': 0.1,  # share of downloads that re-check a neighbouring fragment level
+        'SMOOTHING': 0.3,  # weight of the newest throughput sample
+        'MIN_SAMPLE_BYTES': 1024 * 1024,  # smaller downloads don't update the stats
+        'STATS_TTL': 7 * 24 * 60 * 60,  # seconds a domain's stats live without new samples
+    },
+    # Audio outputs. 'container' is ffmpeg's muxer and 'bitrate' applies when transcoding;
+    # AAC sources are copied into m4a as is. Variants are cached next to their source video.
+    'AUDIO_FORMATS': {
+        'm4a': {'codec': 'aac', 'bitrate': '128k', 'container': 'ipod'},
+        'mp3': {'codec': 'libmp3lame', 'bitrate': '192k', 'container': 'mp3'},
+    },
+    'DEFAULT_AUDIO_FORMAT': 'm4a',
+    'CACHE_MAX_BYTES': 20 * 1024 ** 3,  # 20 GB of finished downloads kept for reuse
+    'CACHE_MAX_AGE': 24 * 60 * 60,  # seconds
+    # Page metadata from /api/download/info/, reused by a download of the same page. Format
+    # URLs in it expire (YouTube's after a few hours), so entries are only kept briefly
+    'INFO_CACHE': {
+        'TTL': 10 * 60,  # seconds
+        'MAX_BYTES': 128 * 1024 ** 2,  # of info JSON, oldest entries go first
+    },
+    'DISK_QUOTA_BYTES': 50 * 1024 ** 3,  # 50 GB of stored downloads, least recently used files go first
+    'PARTIAL_FILE_GRACE': 30 * 60,  # seconds without writes before an unowned .part file is removed
+    'MAINTENANCE_BATCH': 500,  # files indexed or removed per maintenance pass
+    'MAINTENANCE_SHARDS_PER_PASS': 16,  # of the 256 downloads/<xx>/ shard directories
+    'INFLIGHT_TTL': 15 * 60,  # seconds an identical request may attach to a running task
+    'MAX_BATCH_SIZE': 500,  # URLs per batch request, after playlist expansion
+    'HISTORY_FLUSH_SIZE': 100,  # Download row updates a worker buffers before writing them in bulk
+    'HISTORY_FLUSH_INTERVAL': 2,  # seconds an update may wait in that buffer
+    'BULK_STATUS_MAX_IDS': 1000,  # task IDs per bulk status request
+    'BULK_STATUS_MAX_WAIT': 25,  # seconds a bulk status long-poll may block
+    'PROGRESS_INTERVAL': 0.5,  # seconds between progress updates published per task
+    'PROGRESS_KEEPALIVE': 15,  # seconds between SSE keepalives (and result backend checks)
+    'PROGRESS_TTL': 60 * 60,  # seconds the latest progress snapshot is kept
+    'STREAM_CHUNK_SIZE': 256 * 1024,  # bytes per read when following a growing file
+    'STREAM_POLL_INTERVAL': 0.25,  # seconds between checks for newly written bytes
+    # How download_file sends finished files: 'django' (streams from the worker,
+    # with Range support), 'x-accel-redirect' (nginx) or 'x-sendfile' (Apache/lighttpd)
+    'FILE_SERVING': 'django',
+    'X_ACCEL_REDIRECT_PREFIX': '/protected-downloads/',  # nginx `internal` location aliased to downloads/
+    # Where finished downloads are kept. LocalStorage leaves them in downloads/, which
+    # web nodes must then share with the workers (FILE_SERVING applies). S3Storage
+    # uploads them to an S3-compatible bucket and download_file redirects to a
+    # presigned URL, so web nodes and workers can run on separate machines
+    'STORAGE_BACKEND': 'downloader.storage.LocalStorage',
+    'S3': {
+        'BUCKET': os.environ.get('S3_BUCKET', 'downloads'),
+        'ENDPOINT_URL': os.environ.get('S3_ENDPOINT_URL'),  # e.g. http://127.0.0.1:9000 for MinIO; unset for AWS
+        'PUBLIC_ENDPOINT_URL': os.environ.get('S3_PUBLIC_ENDPOINT_URL'),  # if clients reach the store elsewhere
+        'REGION': os.environ.get('S3_REGION', 'us-east-1'),
+        'ACCESS_KEY_ID': os.environ.get('S3_ACCESS_KEY_ID'),
+        'SECRET_ACCESS_KEY': os.environ.get('S3_SECRET_ACCESS_KEY'),
+        'ADDRESSING_STYLE': 'path',  # MinIO and most self-hosted stores don't do bucket subdomains
+        'KEY_PREFIX': '',
+        'MULTIPART_PART_SIZE': 16 * 1024 ** 2,  # files larger than one part are uploaded in parts
+        'UPLOAD_CONCURRENCY': 4,  # parts in flight per upload
+        'URL_EXPIRY': 15 * 60,  # seconds a presigned download URL stays valid
+    },
+    # Download queues, first match wins; an entry without 'domains'/'media_types'
+    # matches everything. Lower priority values are served first. 'weight' is the
+    # share of WORKER_CONCURRENCY a queue's workers get, so one slow site can't
+    # take every slot.
+    'QUEUES': {
+        'downloads.audio': {'media_types': ['audio'], 'priority': 2, 'weight': 2},
+        'downloads.social': {'domains': ['tiktok', 'twitter', 'instagram'], 'priority': 2, 'weight': 2},
+        'downloads.youtube': {'domains': ['youtube'], 'priority': 5, 'weight': 3},
+        'downloads.default': {'priority': 4, 'weight': 1},
+    },
+    'WORKER_CONCURRENCY': 8,  # download slots across all queues
+    'TRANSCODE_QUEUE': 'transcode',  # audio extraction, kept off the download queues
+    'TRANSCODE_CONCURRENCY': os.cpu_count() or 2,  # ffmpeg processes per transcode worker
+    'BATCH_PRIORITY_PENALTY': 3,  # batch items queue behind interactive requests
+    # Admission control for new downloads, per queue. Batch items are not refused.
+    'ADMISSION': {
+        'MAX_QUEUE_WAIT': 10 * 60,  # seconds a new download may expect to wait before it is refused with 503
+        'MAX_QUEUE_DEPTH': 1000,  # messages ahead of a new download; refused beyond this whatever the rate
+        'RATE_WINDOW': 5 * 60,  # seconds of finished runs the drain rate is measured over
+        'MIN_COMPLETIONS': 5,  # fewer runs than this in the window and the rate counts as unknown
+        'RETRY_AFTER': 60,  # seconds suggested when the queue is full and the rate is unknown
+    },
+    'METRICS_FLUSH_INTERVAL': 5,  # seconds a process sums metrics before adding them to Redis
+    # Reused yt-dlp contexts per worker process, keyed by (domain, media type)
+    'POOL': {
+        'WARM': [  # built when a worker process starts
+            ('youtube', 'video'), ('youtube', 'audio'),
+            ('tiktok', 'video'), ('twitter', 'video'), ('instagram', 'video'),
+        ],
+        'MAX_IDLE': 2,  # idle contexts kept per key
+        'MAX_CONTEXTS': 16,  # idle contexts kept per process, least recently used dropped first
+        'MAX_USES': 50,  # tasks a context serves before it is rebuilt (bounds cookies and caches)
+    },
     'ENABLE_PROXY_ROTATION': False,  # Set to True if you have proxies
     'PROXIES': [
         # Add your proxy list here if needed
@@ -156,3 +310,9 @@ VIDEO_DOWNLOADER = {
     ]
 }
 
+
+# A worker started without -Q consumes every download queue plus the default one
+CELERY_TASK_QUEUES = [
+    Queue(name, routing_key=name)
+    for name in [CELERY_TASK_DEFAULT_QUEUE, *VIDEO_DOWNLOADER['QUEUES'], VIDEO_DOWNLOADER['TRANSCODE_QUEUE']]
+]